@@ -1,13 +1,19 @@
+import os
 import glob
 import argparse
 import numpy as np
 import pandas as PD
 from os import path
+from sys import exit
+from pathlib import Path as Pathlib
 from time import sleep
 
 # Locate import
 from modules.EDF_handler import EDF_handler
 from modules.iEEG_handler import ieeg_handler
+from modules.bids_stage import clean_staging, remove_staging
+from modules.metadata_cache import metadata_path
+from modules.subject_ledger import get_subject_ledger, ledger_path
 
 # For testing, mute mne future warning
 import warnings
@@ -30,7 +36,64 @@ def get_proposal_subnums(args,input_data):
     
     return input_data
 
-if __name__ == '__main__':
+def read_failures(args):
+    """
+    Read the failure file back in as input data so only the failed calls are downloaded again.
+
+    Args:
+        args (Namespace): Command line arguments
+
+    Returns:
+        DataFrame: Input data with one row per failed window. In annotation mode there is one row per file, with a
+                   'windows' column holding the failed clip start times (None if the whole file needs to be rerun). Otherwise
+                   a 'file_idx' column holds the input row each window was first listed on.
+    """
+
+    failure_path = args.bidsroot+args.failure_file
+    if not path.exists(failure_path):
+        print(f"No failure file found at {failure_path}. Nothing to retry.")
+        exit()
+
+    # The error message can contain commas, so only split off the leading columns
+    rows = []
+    for iline in open(failure_path,'r'):
+        if iline.strip():
+            rows.append(iline.rstrip('\n').split(',',6)[:6])
+    failures = PD.DataFrame(rows,columns=['uid','orig_filename','start','duration','target','file_idx'])
+    failures['start']    = PD.to_numeric(failures['start'])
+    failures['duration'] = PD.to_numeric(failures['duration'])
+    failures             = failures.drop_duplicates(subset=['uid','orig_filename','start','duration'])
+
+    # Annotation mode reruns whole files, restricted to the clips that failed unless the annotation call itself failed
+    if args.annotations:
+        input_data = []
+        for (iuid,ifile),group in failures.groupby(['uid','orig_filename'],sort=False):
+            if (group['start'].values==-1).any():
+                windows = None
+            else:
+                windows = set(group['start'].values.astype('int64'))
+            input_data.append([iuid,ifile,-1,-1,group['target'].values[0],windows])
+        input_data = PD.DataFrame(input_data,columns=['uid','orig_filename','start','duration','target','windows'])
+    else:
+        input_data = failures.loc[failures['start'].values!=-1].reset_index(drop=True)
+
+        # Windows keep the input row they came from, so a replay writes to the same run. Rows logged before the index was
+        # recorded hold the error message in this column instead and fall back to their replay position.
+        input_data['file_idx'] = PD.to_numeric(input_data['file_idx'],errors='coerce')
+        missing                = input_data['file_idx'].isna().values
+        input_data.loc[missing,'file_idx'] = np.flatnonzero(missing)
+    
+    # Move the replayed entries onto the end of the replay log. Anything that fails again gets written to a fresh failure file.
+    with open(failure_path,'r') as fp:
+        replayed = fp.read()
+    with open(failure_path+'.replayed','a') as fp:
+        fp.write(replayed)
+    os.remove(failure_path)
+    print(f"Replaying {failures.shape[0]} failed calls across {input_data['orig_filename'].unique().size} files.")
+
+    return input_data
+
+def make_parser():
 
     # Command line options needed to obtain data.
     parser = argparse.ArgumentParser(description="iEEG to bids conversion tool.")
@@ -48,6 +111,11 @@ if __name__ == '__main__':
     ieeg_group.add_argument("--dataset", type=str, help="iEEG.org Dataset name")
     ieeg_group.add_argument("--start", type=float, help="Start time of clip")
     ieeg_group.add_argument("--duration", type=float, help="Duration of clip")
+    ieeg_group.add_argument("--chunk_concurrency", "--chunk-concurrency", default=4, type=int, help="Number of 10 minute data chunks to request from iEEG.org at once for each recording.")
+    ieeg_group.add_argument("--request_timeout", default=60, type=float, help="Seconds to wait on a single iEEG.org request before retrying it.")
+    ieeg_group.add_argument("--max_request_rate", default=10, type=float, help="Maximum number of iEEG.org requests per second across all workers. The rate is lowered automatically while iEEG.org throttles requests. 0 disables the limit.")
+    ieeg_group.add_argument("--chunk_cache", default=None, type=str, help="Optional directory to cache downloaded data chunks in. Reruns only download the chunks missing from the cache.")
+    ieeg_group.add_argument("--chunk_cache_size", default=100, type=float, help="Maximum size of the chunk cache in GB. Least recently used chunks are removed first.")
     ieeg_group.add_argument("--failure_file", default='./failed_ieeg_calls.csv', type=str, help="CSV containing failed iEEG calls.")
 
     bids_group = parser.add_argument_group('BIDS options')
@@ -59,17 +127,30 @@ if __name__ == '__main__':
     other_group.add_argument("--subject_file", type=str, default='subject_map.csv', help="File mapping subject id to ieeg file. (Defaults to bidroot+'subject_map.csv)")
     other_group.add_argument("--uid", default=0, type=str, help="Unique patient identifier for single ieeg calls. This is to map patients across different admissions. See sample subject_map.csv file for an example.")
     other_group.add_argument("--target", default=None, type=str, help="Target value to associate with single subject inputs. (i.e. epilepsy vs. pnes)")
-    other_group.add_argument("--multithread", action='store_true', default=False, help="Multithreaded download.")
-    other_group.add_argument("--ncpu", default=1, type=int, help="Number of CPUs to use when downloading.")
+    other_group.add_argument("--multithread", action='store_true', default=False, help="Multithreaded download, or multicore conversion of local EDF files.")
+    other_group.add_argument("--stream", action='store_true', default=False, help="Write each annotation clip to BIDS as soon as it is downloaded instead of holding every clip of a file in memory.")
+    other_group.add_argument("--fast_edf", action='store_true', default=False, help="Encode EDF files directly from the downloaded data instead of converting through an MNE RawArray. mne_bids still writes the sidecar files.")
+    other_group.add_argument("--block_seconds", "--block-seconds", default=None, type=float, help="Convert local EDF files a block of this many seconds at a time, read from the source and written to the BIDS EDF block by block, so memory use does not grow with the length of the recording.")
+    other_group.add_argument("--pipeline_depth", default=0, type=int, help="Write clips to BIDS on a background writer while the next clip downloads. Sets how many downloaded clips can wait for the writer. 0 disables the writer stage.")
+    other_group.add_argument("--retry_failures", "--retry-failures", action='store_true', default=False, help="Only download the calls listed in the iEEG failure file. Use with --cli or --annotations.")
+    other_group.add_argument("--ncpu", default=1, type=int, help="Number of CPUs to use when downloading or converting.")
 
     selection_group = parser.add_mutually_exclusive_group()
     selection_group.add_argument("--cli", action='store_true', default=False, help="Use start and duration from this CLI.")
     selection_group.add_argument("--annotations", action='store_true', default=False, help="CSV file with de-identified unique patient id, ieeg filename, and targets (optional). Format:[uid,ieeg_filename,target]")
-    args = parser.parse_args()
+    return parser
+
+def main(args):
 
     # Clean up directory structure
     if args.bidsroot[-1] != '/':
         args.bidsroot += '/'
+    Pathlib(args.bidsroot).mkdir(parents=True, exist_ok=True)
+
+    # Clear out partial writes left by workers that were killed
+    removed = clean_staging(args.bidsroot)
+    if len(removed) > 0:
+        print(f"Removed {len(removed)} orphaned staging directories.")
 
     # Input data array generation
     incols = ['uid','orig_filename','start','duration','target']
@@ -85,29 +166,60 @@ if __name__ == '__main__':
         for icol in col_diff:
             input_data[icol] = -1
 
-    # Make sure we have numeric types
-    for icol in input_data.columns:
+    # Replay only the failed iEEG calls if requested
+    if args.retry_failures:
+        input_data = read_failures(args)
+
+    # Make sure we have numeric types. Replayed clip windows are sets of start times and stay as they are.
+    for icol in input_data.columns.drop('windows',errors='ignore'):
         try:
             input_data[icol] = PD.to_numeric(input_data[icol],downcast='float')
-        except ValueError:
+        except (ValueError, TypeError):
             pass
 
     # Get the proposed subnums
     input_data = get_proposal_subnums(args,input_data)
 
     # If iEEG.org, pass inputs to that handler to get the data
+    results = None
     if args.ieeg:
         IH = ieeg_handler(args,input_data)
         if not args.multithread:
-            IH.single_pull()
+            results = IH.single_pull()
         else:
-            IH.multicore_pull()
+            results = IH.multicore_pull()
     elif args.edf:
         EH = EDF_handler(args,input_data)
-        EH.save_data()
+        if not args.multithread:
+            EH.save_data()
+        else:
+            EH.multicore_save()
+
+    # Every write has been committed or discarded by now, so the staging root is empty unless something failed
+    remove_staging(args.bidsroot)
+
+    # The ledger is the record of what has been converted. Write it back out as the usual CSV subject map.
+    get_subject_ledger(args.bidsroot+args.subject_file).export_csv()
 
     # Make a bids ignore file
     fp = open(args.bidsroot+'.bidsignore','w')
     fp.write('%s\n' %(args.subject_file))
+    fp.write('%s\n' %(path.basename(metadata_path(args.subject_file))))
+    fp.write('%s*\n' %(path.basename(ledger_path(args.subject_file))))
+    fp.write('.staging/\n')
     fp.write('**targets**pickle')
-    fp.close()
\ No newline at end of file
+    fp.close()
+
+    # Let the caller know if any file failed to download or write
+    n_failed = 0
+    if isinstance(results,PD.DataFrame) and results.shape[0] > 0:
+        n_failed = int((results['status'].values=='failed').sum())
+    if n_failed > 0:
+        print(f"{n_failed} files failed. They are listed in {args.bidsroot+args.failure_file}.")
+    return n_failed
+
+if __name__ == '__main__':
+
+    args = make_parser().parse_args()
+    if main(args) > 0:
+        exit(1)
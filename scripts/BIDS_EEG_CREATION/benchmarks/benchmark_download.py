@@ -0,0 +1,119 @@
+import os
+import sys
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import multiprocessing
+import pandas as PD
+
+# Make the converter and its modules importable from here
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import EEG_BIDS
+from mock_ieeg import mock_service, install
+
+def make_inputs(args, service, workdir):
+    """
+    Write an inputs file of mock datasets. In cli mode each request covers the whole recording.
+
+    Returns:
+        str: Path to the inputs file
+        int: Number of bytes a client downloads for all of the inputs
+    """
+
+    rows = []
+    for idx in range(args.n_files):
+        name = 'MOCK%04d' %(idx)
+        if args.annotations:
+            start,duration = -1,-1
+        else:
+            start,duration = 0,service.recording_length(name)
+        rows.append([idx,name,start,duration,idx%2])
+    inputs = PD.DataFrame(rows,columns=['uid','orig_filename','start','duration','target'])
+
+    inputs_path = os.path.join(workdir,'inputs.csv')
+    inputs.to_csv(inputs_path,index=False)
+    nbytes = sum([service.expected_bytes(*irow) for irow in inputs[['orig_filename','start','duration']].values])
+    return inputs_path,nbytes
+
+def run_once(cli_args, service, queue):
+
+    # Runs in its own process so the peak RSS and the per-process caches belong to this run only
+    install(service)
+    t0 = time.time()
+    try:
+        EEG_BIDS.main(EEG_BIDS.make_parser().parse_args(cli_args))
+    except BaseException:
+        queue.put(None)
+        raise
+    wall = time.time()-t0
+
+    # ru_maxrss is in KB on Linux. For the multicore pull the largest worker is reported.
+    self_rss  = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    child_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    queue.put((wall,max(self_rss,child_rss)/1024))
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmark the iEEG.org downloader against a local mock service.")
+    parser.add_argument("--ncpu", nargs='+', type=int, default=[1,2,4], help="Worker counts to benchmark multicore_pull with.")
+    parser.add_argument("--n_files", type=int, default=8, help="Number of mock datasets to download.")
+    parser.add_argument("--annotations", action='store_true', default=False, help="Download by annotation clips instead of whole recordings.")
+    parser.add_argument("--chunk_concurrency", type=int, default=4, help="Passed through to EEG_BIDS.py.")
+    parser.add_argument("--n_channels", type=int, default=64, help="Channels per mock recording.")
+    parser.add_argument("--fs", type=float, default=256, help="Sampling frequency of the mock recordings.")
+    parser.add_argument("--min_hours", type=float, default=0.5, help="Shortest mock recording in hours.")
+    parser.add_argument("--max_hours", type=float, default=4, help="Longest mock recording in hours.")
+    parser.add_argument("--clip_minutes", type=float, default=30, help="Length of each annotation clip in minutes.")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds of latency added to every mock call.")
+    parser.add_argument("--bandwidth", type=float, default=50, help="Mock transfer rate in MB/s for each request.")
+    parser.add_argument("--failure_rate", type=float, default=0, help="Fraction of mock calls that raise a connection error.")
+    parser.add_argument("--stall_rate", type=float, default=0, help="Fraction of mock calls that hang for --stall_time seconds.")
+    parser.add_argument("--stall_time", type=float, default=300, help="Seconds a stalled mock call hangs for.")
+    parser.add_argument("--skip_single", action='store_true', default=False, help="Do not benchmark single_pull.")
+    parser.add_argument("--output", type=str, default=None, help="Optional CSV to write the results to.")
+    parser.add_argument("--keep", action='store_true', default=False, help="Keep the BIDS output of each run.")
+    args = parser.parse_args()
+
+    service = mock_service(n_channels=args.n_channels, fs=args.fs, min_hours=args.min_hours, max_hours=args.max_hours,
+                           clip_minutes=args.clip_minutes, latency=args.latency, bandwidth=args.bandwidth,
+                           failure_rate=args.failure_rate, stall_rate=args.stall_rate, stall_time=args.stall_time)
+    workdir            = tempfile.mkdtemp(prefix='ieeg_benchmark_')
+    inputs_path,nbytes = make_inputs(args,service,workdir)
+
+    # single_pull first, then multicore_pull at each worker count
+    runs = [] if args.skip_single else [('single_pull',1)]
+    runs.extend([('multicore_pull',ncpu) for ncpu in args.ncpu])
+
+    results = []
+    context = multiprocessing.get_context('fork')
+    for method,ncpu in runs:
+        bidsroot = os.path.join(workdir,f"{method}_{ncpu:02d}")+'/'
+        cli_args = ['--ieeg','--username','mock','--password','mock','--bidsroot',bidsroot,'--session','benchmark',
+                    '--inputs_file',inputs_path,'--annotations' if args.annotations else '--cli',
+                    '--chunk_concurrency',str(args.chunk_concurrency),'--ncpu',str(ncpu)]
+        if method == 'multicore_pull':
+            cli_args.append('--multithread')
+
+        queue   = context.Queue()
+        process = context.Process(target=run_once, args=(cli_args,service,queue))
+        process.start()
+        output  = queue.get()
+        process.join()
+        if output == None:
+            print(f"{method} with {ncpu} cpus failed. Skipping.")
+            continue
+        wall,peak_rss = output
+
+        results.append({'method':method,'ncpu':ncpu,'files':args.n_files,'wall_s':wall,
+                        'files_per_hour':3600*args.n_files/wall,'MB_per_s':1e-6*nbytes/wall,'peak_rss_MB':peak_rss})
+        if not args.keep:
+            shutil.rmtree(bidsroot,ignore_errors=True)
+
+    results = PD.DataFrame(results)
+    print(results.to_string(index=False,float_format='%.2f'))
+    if args.output != None:
+        results.to_csv(args.output,index=False)
+    if not args.keep:
+        shutil.rmtree(workdir,ignore_errors=True)
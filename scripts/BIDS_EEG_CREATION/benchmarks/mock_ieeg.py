@@ -0,0 +1,173 @@
+import zlib
+import random
+import requests
+import numpy as np
+from time import sleep
+import ieeg.ieeg_api as IIA
+
+class mock_service:
+    """
+    Local stand-in for iEEG.org that serves synthetic recordings.
+
+    Every dataset name maps to a reproducible recording (length, clip layer, Natus annotations) so the same inputs can be
+    benchmarked again later. Latency, bandwidth and failures are injected on every call that would hit the network.
+    """
+
+    def __init__(self, n_channels=64, fs=256., min_hours=1, max_hours=24, clip_minutes=60, gap_minutes=5,
+                 annotations_per_clip=5, latency=0.05, bandwidth=50, failure_rate=0, stall_rate=0, stall_time=300):
+        self.n_channels           = n_channels
+        self.fs                   = fs
+        self.min_hours            = min_hours
+        self.max_hours            = max_hours
+        self.clip_minutes         = clip_minutes
+        self.gap_minutes          = gap_minutes
+        self.annotations_per_clip = annotations_per_clip
+        self.latency              = latency
+        self.bandwidth            = bandwidth
+        self.failure_rate         = failure_rate
+        self.stall_rate           = stall_rate
+        self.stall_time           = stall_time
+
+    def network_call(self, nbytes=0):
+        """
+        Wait as long as a real call would take, then fail or stall it at random.
+
+        Args:
+            nbytes (int, optional): Size of the response. Transfer time is nbytes over the bandwidth in MB/s.
+        """
+
+        sleep(self.latency+nbytes/(self.bandwidth*1e6))
+        if random.random() < self.stall_rate:
+            sleep(self.stall_time)
+        if random.random() < self.failure_rate:
+            raise IIA.IeegConnectionError("Injected mock iEEG.org failure.")
+
+    def recording_length(self, name):
+
+        # Seed on the dataset name so each dataset always has the same length
+        rng = np.random.default_rng(zlib.crc32(name.encode()))
+        return int(rng.uniform(self.min_hours,self.max_hours)*3600*1e6)
+
+    def clip_windows(self, name):
+
+        clip   = int(self.clip_minutes*60*1e6)
+        step   = clip+int(self.gap_minutes*60*1e6)
+        starts = np.arange(0,self.recording_length(name)-clip+1,step)
+        return [(int(istart),int(istart)+clip) for istart in starts]
+
+    def expected_bytes(self, name, start=-1, duration=-1):
+        """
+        Number of float64 bytes a client downloads for a request. A start of -1 means every annotation clip.
+        """
+
+        if start == -1:
+            duration = sum([iend-istart for istart,iend in self.clip_windows(name)])
+        return int(round(1e-6*duration*self.fs))*self.n_channels*8
+
+def mock_labels(n_channels):
+
+    # Scalp style labels so every channel is typed as eeg, matching the eeg datatype the converter writes
+    leads = ['Fp','F','C','P','O','T']
+    return ['%s%d' %(leads[ichannel%len(leads)],ichannel//len(leads)+1) for ichannel in range(n_channels)]
+
+class mock_annotation:
+
+    def __init__(self, _type, description, start_time_offset_usec, end_time_offset_usec):
+        self.type                   = _type
+        self.description            = description
+        self.start_time_offset_usec = start_time_offset_usec
+        self.end_time_offset_usec   = end_time_offset_usec
+
+class mock_details:
+
+    def __init__(self, label, sample_rate, number_of_samples):
+        self.channel_label     = label
+        self.sample_rate       = sample_rate
+        self.number_of_samples = number_of_samples
+
+class mock_dataset:
+
+    def __init__(self, name, service):
+        self.name       = name
+        self.service    = service
+        self.ch_labels  = mock_labels(service.n_channels)
+        self.start_time = 1600000000000000
+        self.end_time   = self.start_time+service.recording_length(name)
+
+    def get_time_series_details(self, label):
+        return mock_details(label,self.service.fs,int(1e-6*(self.end_time-self.start_time)*self.service.fs))
+
+    def get_data(self, start, duration, channels):
+
+        # Sine waves at a different frequency on every channel, in the (sample, channel) layout of the real client. The
+        # converter hands these values to MNE as is, so keep them at a volt scale amplitude.
+        n_samples = int(round(1e-6*duration*self.service.fs))
+        self.service.network_call(n_samples*len(channels)*8)
+        times     = (int(round(1e-6*start*self.service.fs))+np.arange(n_samples))/self.service.fs
+        freqs     = 1+np.array(channels)%40
+        return 50e-6*np.sin(2*np.pi*np.outer(times,freqs))
+
+    def get_annotations(self, layer_name):
+
+        self.service.network_call()
+        windows = self.service.clip_windows(self.name)
+        if layer_name == 'EEG clip times':
+            annotations = []
+            for istart,iend in windows:
+                annotations.append(mock_annotation('Clip Start','Clip Start',istart,istart))
+                annotations.append(mock_annotation('Clip End','Clip End',iend,iend))
+            return annotations
+
+        # Natus style events at reproducible times inside each clip
+        rng         = np.random.default_rng(zlib.crc32(self.name.encode())+1)
+        labels      = ['Seizure','Spike','Eyes Closed','Movement','Technician Note']
+        annotations = []
+        for istart,iend in windows:
+            for itime in np.sort(rng.integers(istart,iend,self.service.annotations_per_clip)):
+                annotations.append(mock_annotation('Annotation',labels[rng.integers(len(labels))],int(itime),int(itime)))
+        return annotations
+
+class mock_api:
+
+    def __init__(self):
+        # The session pool mounts its adapters on this, like on the real client
+        self.http = requests.Session()
+
+    def close(self):
+        self.http.close()
+
+class mock_session:
+    """
+    Drop-in replacement for ieeg.auth.Session. The service it talks to is set by install().
+    """
+
+    service = None
+
+    def __init__(self, name, pwd, verify_ssl=True, mprov_listener=None):
+        self.username = name
+        self.api      = mock_api()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def close(self):
+        self.api.close()
+
+    def open_dataset(self, name):
+
+        # Dataset id, time series details and montages are three round-trips on the real service
+        for icall in range(3):
+            mock_session.service.network_call()
+        return mock_dataset(name,mock_session.service)
+
+def install(service):
+    """
+    Point the downloader's session pool at the mock service. Workers forked afterwards inherit the patch.
+    """
+
+    import modules.session_pool
+    mock_session.service         = service
+    modules.session_pool.Session = mock_session
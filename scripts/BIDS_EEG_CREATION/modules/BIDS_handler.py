@@ -1,3 +1,4 @@
+import os
 import re
 import mne
 import glob
@@ -6,15 +7,24 @@ import getpass
 import mne_bids
 import numpy as np
 import pandas as PD
-from os import path
 from datetime import date
-from mne_bids import BIDSPath, write_raw_bids
+from mne_bids import BIDSPath, write_raw_bids, update_sidecar_json
+
+# Local imports
+from modules.edf_probe import edf_probe
+from modules.edf_writer import write_edf, stream_edf
+from modules.bids_stage import get_bids_stage
+from modules.subject_ledger import get_subject_ledger
+from modules.completion_index import times_key, source_type
 
 class BIDS_handler:
 
     def __init__(self):
         self.raws      = []
+        self.raw_idx   = []
+        self.n_saved   = 0
         self.data_info = {'iEEG_id':self.current_file}
+        self.stage     = get_bids_stage(self.args.bidsroot,self.write_lock)
         self.get_subject_number()
         self.get_session_number()
 
@@ -25,18 +35,12 @@ class BIDS_handler:
 
     def get_subject_number(self):
 
-        # Load the mapping if available, otherwise dummy dataframe
-        if not path.exists(self.subject_path):
-            subject_uid_df = PD.DataFrame(np.empty((1,3)),columns=['iEEG file','uid','subject_number'])
-        else:
-            subject_uid_df = PD.read_csv(self.subject_path)
-
         # Check if we already have this subject
-        uids = subject_uid_df['uid'].values
-        if self.uid not in uids:
+        subject_num = get_subject_ledger(self.subject_path).get_subject_number(self.uid)
+        if subject_num == None:
             self.subject_num = self.proposed_sub
         else:
-            self.subject_num = int(subject_uid_df['subject_number'].values[np.where(uids==self.uid)[0][0]])
+            self.subject_num = subject_num
 
     def get_session_number(self):
 
@@ -65,127 +69,218 @@ class BIDS_handler:
         # Get the outputs of each channel
         channel_expressions = [regex.match(ichannel) for ichannel in self.channels]
 
-        # Make the channel types
-        self.channel_types = []
+        # Make the channel types. Built up locally, since a background writer can be reading the previous clip's types.
+        channel_types = []
         for iexpression in channel_expressions:
             if iexpression == None:
-                self.channel_types.append('misc')
+                channel_types.append('misc')
             else:
                 lead = iexpression.group(1)
                 contact = int(iexpression.group(2))
                 if lead.lower() in ["ecg", "ekg"]:
-                    self.channel_types.append('ecg')
+                    channel_types.append('ecg')
                 elif lead.lower() in ['c', 'cz', 'cz', 'f', 'fp', 'fp', 'fz', 'fz', 'o', 'p', 'pz', 'pz', 't']:
-                    self.channel_types.append('eeg')
+                    channel_types.append('eeg')
                 else:
-                    self.channel_types.append(1)
+                    channel_types.append(1)
 
         # Do some final clean ups based on number of leads
         lead_sum = 0
-        for ival in self.channel_types:
+        for ival in channel_types:
             if isinstance(ival,int):lead_sum+=1
         if lead_sum > threshold:
             remaining_leads = 'ecog'
         else:
             remaining_leads = 'seeg'
-        for idx,ival in enumerate(self.channel_types):
-            if isinstance(ival,int):self.channel_types[idx] = remaining_leads
-        self.channel_types = np.array(self.channel_types)
+        for idx,ival in enumerate(channel_types):
+            if isinstance(ival,int):channel_types[idx] = remaining_leads
+        channel_types = np.array(channel_types)
 
         # Make the dictionary for mne
-        self.channel_types = PD.DataFrame(self.channel_types.reshape((-1,1)),index=self.channels,columns=["type"])
+        self.channel_types = PD.DataFrame(channel_types.reshape((-1,1)),index=self.channels,columns=["type"])
 
     def make_info(self):
         self.data_info = mne.create_info(ch_names=list(self.channels), sfreq=self.fs, verbose=False)
 
-    def add_raw(self):
-        self.raws.append(mne.io.RawArray(self.data.T, self.data_info, verbose=False))
+    def add_raw(self, idx=None):
 
-    def event_mapper(self):
+        # Keep track of which clip each raw belongs to so runs and annotations stay paired up if a clip is missing
+        if idx == None:
+            idx = len(self.raws)
 
-        keys = np.unique(self.annotation_flats)
-        vals = np.arange(keys.size)
-        self.event_mapping = dict(zip(keys,vals))
+        # The fast EDF writer encodes straight from the data buffer, so keep the array itself rather than a RawArray. Files
+        # converted in blocks are kept as the open probe of the source file. Clips with gaps (NaN) cannot be encoded as they
+        # are and go through mne_bids, which handles them like any other clip it cannot write.
+        if isinstance(self.data,edf_probe):
+            self.raws.append(self.data)
+        elif self.args.fast_edf and float(self.fs).is_integer() and np.isfinite(self.data).all():
+            self.raws.append(self.data)
+        else:
+            self.raws.append(mne.io.RawArray(self.data, self.data_info, verbose=False))
+        self.raw_idx.append(idx)
 
-    def annotation_save(self,idx,raw):
+    def encode_edf(self, data, tmp_path):
+        """
+        Write a clip to a temporary EDF with the fast writer and open it again without loading the data.
 
-        # Make the events file and save the results
-        for itime in list(self.annotations[idx].keys()):
+        mne_bids then copies the file into place as is and only has to write the sidecar files. A probed source file is
+        encoded --block_seconds at a time and closed afterwards.
+
+        Args:
+            data (array or edf_probe): Clip data in volts, shaped (channels, samples), or the probe of a local EDF file.
+            tmp_path (str): Temporary EDF to write. The caller removes it once the clip is written or has failed.
+
+        Returns:
+            mne.io.Raw: Lazily read raw matching the RawArray the clip would otherwise have been written from.
+        """
+
+        if isinstance(data,edf_probe):
+            self.clip_samples = data.n_samples
+            block_samples     = max(1,int(self.args.block_seconds))*int(self.fs)
             try:
-                desc   = self.annotations[idx][itime]
-                index  = (1e-6*itime)*self.fs
-                events = np.array([[int(index),0,self.event_mapping[desc]]])
+                mins,maxs = data.extremes()
+                stream_edf(tmp_path, data.read_samples, data.n_samples, self.fs, list(self.channels),
+                           self.channel_types.type.values, mins, maxs, block_samples)
+            finally:
+                data.close()
+        else:
+            self.clip_samples = data.shape[1]
+            write_edf(tmp_path, data, self.fs, list(self.channels), self.channel_types.type.values)
+
+        # Drop what the EDF header adds on read (padding annotation, default start date and patient) so the sidecars match
+        raw = mne.io.read_raw_edf(tmp_path, preload=False, verbose=False)
+        raw.set_channel_types(dict(zip(raw.ch_names,self.channel_types.type.values)), verbose=False)
+        raw.set_annotations(None)
+        raw.set_meas_date(None)
+        raw.info['subject_info'] = None
+        return raw
 
-                # Save the edf in bids format
-                session_str    = "%s%03d" %(self.args.session,self.session_number)
-                self.bids_path = mne_bids.BIDSPath(root=self.args.bidsroot, datatype='eeg', session=session_str, subject='%05d' %(self.subject_num), run=idx+1, task='task')
-                write_raw_bids(bids_path=self.bids_path, raw=raw, events_data=events,event_id=self.event_mapping, allow_preload=True, format='EDF',verbose=False)
+    def fix_duration(self, raw):
 
-                # Save the targets with the edf path paired up to filetype
-                target_path = str(self.bids_path.copy()).rstrip('.edf')+'_targets.pickle'
-                target_dict = {'uid':self.uid,'target':self.target,'annotation':desc}
-                pickle.dump(target_dict,open(target_path,"wb"))
+        # A partial last second is padded out to a whole EDF record by the fast writer, which mne_bids would otherwise
+        # count in the recording duration
+        if not raw.preload and raw.n_times > self.clip_samples:
+            sidecar = self.bids_path.copy().update(suffix='eeg', extension='.json')
+            update_sidecar_json(sidecar, {'RecordingDuration':(self.clip_samples-1)/raw.info['sfreq']}, verbose=False)
 
-            except:
+    def write_options(self, raw):
 
-                # If the data fails to write in anyway, save the raw as a pickle so we can fix later without redownloading it
-                error_path = str(self.bids_path.copy()).rstrip('.edf')+'.pickle'
-                pickle.dump((raw,events,self.event_mapping),open(error_path,"wb"))
+        # Clips already encoded by the fast writer are read lazily and copied into place as is, anything in memory is
+        # converted to EDF by mne_bids
+        if raw.preload:
+            return {'allow_preload':True,'format':'EDF'}
+        return {'allow_preload':False,'format':'auto'}
+
+    def event_mapper(self):
+
+        keys = np.unique(self.annotation_flats)
+        vals = np.arange(keys.size)
+        self.event_mapping = dict(zip(keys,vals))
+
+    def annotation_save(self,idx,raw):
+
+        # Gather every annotation of the clip into one events array so the clip is only written once
+        itimes = sorted(self.annotations[idx].keys())
+        descs  = [self.annotations[idx][itime] for itime in itimes]
+        fs     = raw.info['sfreq']
+        events = np.array([[int((1e-6*itime)*fs),0,self.event_mapping[desc]] for itime,desc in zip(itimes,descs)])
+
+        try:
+            # Save the edf in bids format
+            session_str    = "%s%03d" %(self.args.session,self.session_number)
+            self.bids_path = mne_bids.BIDSPath(root=self.stage.root, datatype='eeg', session=session_str, subject='%05d' %(self.subject_num), run=idx+1, task='task')
+            write_raw_bids(bids_path=self.bids_path, raw=raw, events=events, event_id=self.event_mapping, verbose=False, overwrite=True, **self.write_options(raw))
+            self.fix_duration(raw)
+
+            # Save the targets with the edf path paired up to filetype. One record holds every annotation of the clip.
+            target_path = str(self.bids_path.copy()).rstrip('.edf')+'_targets.pickle'
+            target_dict = {'uid':self.uid,'target':self.target,'annotation':descs}
+            pickle.dump(target_dict,open(target_path,"wb"))
+
+        except:
+
+            # If the data fails to write in anyway, save the raw as a pickle so we can fix later without redownloading it.
+            # Partial output is dropped from the staging area and the pickle is kept with the other failed writes.
+            if not raw.preload:
+                raw.load_data(verbose=False)
+            self.stage.discard()
+            error_path = self.stage.failed_path(str(self.bids_path.copy()).rstrip('.edf')+'.pickle')
+            pickle.dump((raw,events,self.event_mapping),open(error_path,"wb"))
 
     def direct_save(self,idx,raw):
 
         # Save the edf in bids format
         run_number     = int(self.file_idx)+1
         session_str    = "%s%03d" %(self.args.session,self.session_number)
-        self.bids_path = mne_bids.BIDSPath(root=self.args.bidsroot, datatype='eeg', session=session_str, subject='%05d' %(self.subject_num), run=run_number, task='task')
-        write_raw_bids(bids_path=self.bids_path, raw=raw, allow_preload=True, format='EDF',verbose=False,overwrite=True)
+        self.bids_path = mne_bids.BIDSPath(root=self.stage.root, datatype='eeg', session=session_str, subject='%05d' %(self.subject_num), run=run_number, task='task')
+        write_raw_bids(bids_path=self.bids_path, raw=raw, verbose=False, overwrite=True, **self.write_options(raw))
+        self.fix_duration(raw)
         
         # Save the targets with the edf path paired up to filetype
         target_path = str(self.bids_path.copy()).rstrip('.edf')+'_targets.pickle'
         target_dict = {'uid':self.uid,'target':self.target}
         pickle.dump(target_dict,open(target_path,"wb"))
 
+    def save_raw(self,idx,raw):
+
+        # Write to the staging area, then move the clip into the BIDS root once it is complete
+        self.stage.open()
+        tmp_path = None
+        try:
+            # Set the channel types, or encode the EDF ourselves if the clip was kept as a plain array or a probed source file
+            if not isinstance(raw,mne.io.BaseRaw):
+                tmp_path = self.stage.scratch_file('.fast_edf_','.edf')
+                raw      = self.encode_edf(raw,tmp_path)
+            else:
+                raw.set_channel_types(self.channel_types.type)
+
+            if not hasattr(self,'annotations'):
+                self.direct_save(idx,raw)
+            elif len(self.annotations[idx].keys()):
+                self.annotation_save(idx,raw)
+            self.stage.commit()
+        except:
+            self.stage.discard()
+            raise
+        finally:
+            # The temporary EDF has been copied by now, or the write failed. Either way it is not part of the clip.
+            if tmp_path != None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.n_saved += 1
+
+    def stream_raw(self):
+        """
+        Write the most recently added raw to BIDS right away and free it, so only one clip is held in memory at a time.
+        """
+
+        idx = self.raw_idx.pop()
+        raw = self.raws.pop()
+        self.save_raw(idx,raw)
+        del raw
+        self.data = None
+
     def save_bids(self):
 
         # Loop over all the raw data, add annotations, save
-        for idx, raw in enumerate(self.raws):
-            
-            # Set the channel types
-            raw.set_channel_types(self.channel_types.type)
+        for idx, raw in zip(self.raw_idx,self.raws):
+            self.save_raw(idx,raw)
+        self.raws    = []
+        self.raw_idx = []
 
-            # Check for annotations
-            try:
-                if len(self.annotations[idx].keys()):
-                    self.annotation_save(idx,raw)
-            except AttributeError:
-                self.direct_save(idx,raw)
+        # Only record the file in the subject map if something was written
+        if self.n_saved > 0:
+            self.update_subject_map()
+            self.n_saved = 0
+
+    def update_subject_map(self):
 
-        # Prepare some metadata for download
-        source  = np.array(['ieeg.org','edf'])
-        inds    = [self.args.ieeg,self.args.edf]
-        source  = source[inds][0]
+        # Prepare some metadata for download. The times are those of this input row, so the completion index can tell
+        # windows of the same file apart.
+        source  = source_type(self.args)
         user    = getpass.getuser()
         gendate = date.today().strftime("%d-%m-%y")
-        if self.args.annotations:
-            times = 'annots'
-        else:
-            times = f"{self.args.start}_{self.args.duration}"
-
-        # Save the subject file info with source metadata
-        columns = ['orig_filename','source','creator','gendate','uid','subject_number','session_number','times']
-        iDF     = PD.DataFrame([[self.current_file,source,user,gendate,self.uid,self.subject_num,self.session_number,times]],columns=columns)
+        times   = times_key(self.args,getattr(self,'start',None),getattr(self,'duration',None))
 
-        if not path.exists(self.subject_path):
-            subject_DF = iDF.copy()
-        else:
-            subject_DF = PD.read_csv(self.subject_path)
-            subject_DF = PD.concat((subject_DF,iDF))
-        subject_DF['subject_number'] = subject_DF['subject_number'].astype(str).str.zfill(4)
-        subject_DF['session_number'] = subject_DF['session_number'].astype(str).str.zfill(4)
-
-        # Only write files one at a time
-        if self.write_lock != None:
-            with self.write_lock:
-                subject_DF.to_csv(self.subject_path,index=False)
-        else:
-            subject_DF.to_csv(self.subject_path,index=False)
\ No newline at end of file
+        # Record the file in the subject ledger. Each row is its own transaction, so workers do not need the write lock.
+        ledger = get_subject_ledger(self.subject_path)
+        ledger.append(self.current_file,source,user,gendate,self.uid,self.subject_num,self.session_number,times)
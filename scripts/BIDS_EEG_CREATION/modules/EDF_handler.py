@@ -1,9 +1,28 @@
+import numpy as np
+import pandas as PD
 from sys import exit
+from os import path, getpid
 from mne.io import read_raw_edf
-from pyedflib.highlevel import read_edf_header
+
+# Multicore support
+import multiprocessing
 
 # Local imports
 from modules.BIDS_handler import BIDS_handler
+from modules.edf_probe import edf_probe
+from modules.subject_ledger import get_subject_ledger
+from modules.completion_index import completion_index, times_key
+
+# Handler shared by every group of files a pool worker converts. Set once per worker by init_worker.
+worker_handler = None
+
+def init_worker(handler, write_lock):
+    global worker_handler
+    handler.write_lock = write_lock
+    worker_handler     = handler
+
+def save_worker(file_indices):
+    return worker_handler.save_group(file_indices)
 
 class EDF_handler(BIDS_handler):
 
@@ -11,17 +30,88 @@ class EDF_handler(BIDS_handler):
         self.args              = args
         self.input_data        = input_data
         self.input_files       = input_data['orig_filename'].values
-        self.all_proposed_subs = input_data['proposed_subnum']
+        self.all_proposed_subs = input_data['proposed_subnum'].values
         self.subject_path      = args.bidsroot+args.subject_file
         self.old_uid           = -999
         self.write_lock        = None
+
+        # Everything converted by earlier runs, loaded once
+        self.index = completion_index(get_subject_ledger(self.subject_path))
     
     def save_data(self):
-        for ii,self.current_file in enumerate(self.input_files):
+
+        file_indices = np.array(range(self.input_files.size))
+        self.save_files(file_indices)
+
+    def multicore_save(self):
+        """
+        Convert the files on a process pool. Every file of a uid goes to the same worker, in input order, so subject and
+        session numbers come out the same as on a single core.
+        """
+
+        # Drop converted files before anything is handed to the workers
+        file_indices = np.array([idx for idx in range(self.input_files.size) if not self.is_done(idx)],dtype=int)
+        if file_indices.size < self.input_files.size:
+            print(f"Skipping {self.input_files.size-file_indices.size} files that are already converted.")
+        if file_indices.size == 0:
+            return
+
+        # Largest subjects first so a big one does not start last and hold up the end of the run
+        uids   = self.input_data['uid'].values[file_indices]
+        groups = [np.array(igroup) for _,igroup in PD.Series(file_indices).groupby(uids,sort=False)]
+        sizes  = [sum([path.getsize(self.input_files[idx]) for idx in igroup if path.exists(self.input_files[idx])]) for igroup in groups]
+        groups = [groups[idx] for idx in np.argsort(-np.array(sizes),kind='stable')]
+
+        write_lock = multiprocessing.Lock()
+        results    = []
+        pool       = multiprocessing.Pool(self.args.ncpu, initializer=init_worker, initargs=(self,write_lock))
+        for result in pool.imap_unordered(save_worker, groups, chunksize=1):
+            results.append(result)
+            print(f"Finished uid {result['uid']} ({result['status']}). ({len(results):04d}/{len(groups):04d})")
+        pool.close()
+        pool.join()
+
+        results = PD.DataFrame(results)
+        print(results['status'].value_counts().to_string())
+        return results
+
+    def save_group(self, file_indices):
+        """
+        Convert the files of one uid on a pool worker.
+
+        Returns:
+            dict: Summary of the task with the uid, status and worker pid.
+        """
+
+        uid    = self.input_data['uid'].values[file_indices[0]]
+        status = 'converted'
+        try:
+            self.save_files(file_indices)
+        except Exception as e:
+            # Keep a single bad subject from taking down the rest of the queue
+            print(f"Unable to convert uid {uid}: {e}")
+            status = 'failed'
+        return {'uid':uid,'status':status,'pid':getpid()}
+
+    def is_done(self, file_idx):
+        times = times_key(self.args,self.input_data['start'].values[file_idx],self.input_data['duration'].values[file_idx])
+        return self.index.is_done(self.input_files[file_idx],times,'edf')
+
+    def save_files(self, file_indices):
+        for ii in file_indices:
+            self.current_file = self.input_files[ii]
             self.file_idx     = ii
             self.uid          = self.input_data['uid'].values[ii]
             self.target       = self.input_data['target'].values[ii]
             self.proposed_sub = self.all_proposed_subs[ii]
+            self.start        = self.input_data['start'].values[ii]
+            self.duration     = self.input_data['duration'].values[ii]
+
+            # Skip files an earlier run already converted
+            if self.is_done(ii):
+                print("Skipping %s." %(self.current_file))
+                continue
+
             flag        = self.edf_test()
             if self.uid != self.old_uid:
                 BIDS_handler.__init__(self)
@@ -36,16 +126,37 @@ class EDF_handler(BIDS_handler):
             BIDS_handler.save_bids(self)
 
     def edf_test(self):
+
+        # The header is only parsed here. The probe keeps the file open and is handed on to read_edf.
+        self.probe = None
         try:
-            read_edf_header(self.current_file)
+            self.probe = edf_probe(self.current_file)
             return True
         except Exception as e:
             return False
 
     def read_edf(self):
 
-        # Read in the data via mne backend
-        raw           = read_raw_edf(self.current_file,verbose=False)
-        self.data     = raw.get_data().T
-        self.channels = raw.ch_names
-        self.fs       = raw.info.get('sfreq')
\ No newline at end of file
+        if self.probe.mixed_rates:
+            # Known from the header alone. Let mne bring every channel up to a common rate.
+            self.probe.close()
+            print(f"{self.current_file} has mixed sampling rates. Reading it through mne.")
+            raw           = read_raw_edf(self.current_file,verbose=False)
+            self.data     = raw.get_data()
+            self.channels = raw.ch_names
+            self.fs       = raw.info.get('sfreq')
+            return
+
+        if self.streamed():
+            # Left on disk. The BIDS writer reads and encodes it a block at a time, then closes the probe.
+            self.data = self.probe
+        else:
+            try:
+                self.data = self.probe.read()
+            finally:
+                self.probe.close()
+        self.channels = self.probe.channels
+        self.fs       = self.probe.fs
+
+    def streamed(self):
+        return self.args.block_seconds != None and self.probe.fs.is_integer()
@@ -0,0 +1,195 @@
+import os
+import time
+import uuid
+import shutil
+import tempfile
+import socket
+import contextlib
+import pandas as PD
+from multiprocessing.util import Finalize
+
+# Dataset level files every write produces. They are merged into, or only moved into, the live tree.
+merge_keys  = {'participants.tsv':'participant_id'}
+keep_first  = ['dataset_description.json','README','participants.json']
+
+class bids_stage:
+    """
+    Per-worker staging area that BIDS files are written into before they are moved into the live BIDS root.
+
+    The staging directory sits under bidsroot/.staging, so it is on the same filesystem and every file is committed with an
+    atomic rename. BIDS files are written to its bids/ folder, which is what gets committed, and scratch files to its tmp/
+    folder, which never is. It is made by open when a write starts and removed again once the write is committed or
+    discarded. A worker killed mid-write only leaves files behind in its own staging directory, which the next run removes.
+    Dataset level tables (participants.tsv, scans.tsv) are merged into the live copies under the write lock.
+    """
+
+    def __init__(self, bidsroot, write_lock=None):
+        self.bidsroot   = bidsroot
+        self.write_lock = write_lock
+        self.path       = os.path.join(staging_path(bidsroot),f"{socket.gethostname()}_{os.getpid()}_{uuid.uuid4().hex}")
+        self.root       = os.path.join(self.path,'bids')+'/'
+        self.scratch    = os.path.join(self.path,'tmp')+'/'
+        self.failed     = os.path.join(staging_path(bidsroot),'failed')+'/'
+
+    def open(self):
+        os.makedirs(self.root, exist_ok=True)
+        os.makedirs(self.scratch, exist_ok=True)
+
+    def scratch_file(self, prefix='', suffix=''):
+        """
+        Make an empty temporary file outside of the committed tree. The caller removes it, or discard does.
+        """
+
+        fd,fpath = tempfile.mkstemp(prefix=prefix, suffix=suffix, dir=self.scratch)
+        os.close(fd)
+        return fpath
+
+    def locked(self):
+        if self.write_lock != None:
+            return self.write_lock
+        return contextlib.nullcontext()
+
+    def failed_path(self, fpath):
+        """
+        Location to keep a failed write at, outside of the worker staging area so it survives the cleanup.
+        """
+
+        failed_path = os.path.join(self.failed,os.path.relpath(fpath,self.root))
+        os.makedirs(os.path.dirname(failed_path), exist_ok=True)
+        return failed_path
+
+    def commit(self):
+        """
+        Move everything written to the staging area into the live BIDS root.
+        """
+
+        data_files = []
+        meta_files = []
+        for dirpath,dirnames,filenames in os.walk(self.root):
+            for ifile in filenames:
+                src = os.path.join(dirpath,ifile)
+                rel = os.path.relpath(src,self.root)
+                if rel in merge_keys or rel in keep_first or ifile.endswith('_scans.tsv'):
+                    meta_files.append(rel)
+                else:
+                    data_files.append(rel)
+
+        with self.locked():
+
+            # Data files first, so the tables never point at a file that is not there yet
+            for rel in data_files:
+                dst = os.path.join(self.bidsroot,rel)
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                os.replace(os.path.join(self.root,rel),dst)
+
+            for rel in meta_files:
+                src = os.path.join(self.root,rel)
+                dst = os.path.join(self.bidsroot,rel)
+                if rel in keep_first:
+                    if not os.path.exists(dst):
+                        os.replace(src,dst)
+                    else:
+                        os.remove(src)
+                elif rel in merge_keys:
+                    merge_tsv(src,dst,merge_keys[rel])
+                else:
+                    merge_tsv(src,dst,'filename')
+        self.discard()
+
+    def discard(self):
+        """
+        Drop the staging area along with whatever is in it, e.g. the partial output of a failed write.
+        """
+
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def close(self):
+        self.discard()
+
+def merge_tsv(src, dst, key):
+    """
+    Merge a staged BIDS table into the live one. Staged rows replace live rows with the same key.
+    """
+
+    staged = PD.read_csv(src, sep='\t', dtype=str, keep_default_na=False)
+    if os.path.exists(dst):
+        live   = PD.read_csv(dst, sep='\t', dtype=str, keep_default_na=False)
+        live   = live.loc[~live[key].isin(staged[key])]
+        staged = PD.concat((live,staged)).fillna('n/a')
+        staged = staged[list(live.columns)+[icol for icol in staged.columns if icol not in live.columns]]
+
+    # Write the merged table in the staging area and swap it in
+    tmp_path = f"{src}.merge"
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    staged.to_csv(tmp_path, sep='\t', index=False)
+    os.replace(tmp_path,dst)
+    os.remove(src)
+
+def staging_path(bidsroot):
+    return os.path.join(bidsroot,'.staging')
+
+def clean_staging(bidsroot, max_age=2*86400):
+    """
+    Remove staging directories left behind by workers that did not exit cleanly.
+
+    Directories from this host are removed once their process is gone. Directories from other hosts are only removed once
+    they have not been touched for max_age seconds, since we cannot check on their processes.
+
+    Returns:
+        list: Removed staging directories
+    """
+
+    removed = []
+    root    = staging_path(bidsroot)
+    if not os.path.exists(root):
+        return removed
+
+    host = socket.gethostname()
+    for iname in os.listdir(root):
+        ipath = os.path.join(root,iname)
+        parts = iname.rsplit('_',2)
+        if iname == 'failed' or len(parts) != 3 or not os.path.isdir(ipath):
+            continue
+
+        ihost,ipid,_ = parts
+        if ihost == host:
+            orphan = not pid_alive(int(ipid))
+        else:
+            orphan = (time.time()-os.path.getmtime(ipath)) > max_age
+        if orphan:
+            shutil.rmtree(ipath, ignore_errors=True)
+            removed.append(ipath)
+    return removed
+
+def remove_staging(bidsroot):
+    """
+    Remove the staging root at the end of a run. It is kept if it still holds failed writes or the staging directory of
+    another run.
+    """
+
+    try:
+        os.rmdir(staging_path(bidsroot))
+    except OSError:
+        pass
+
+def pid_alive(pid):
+    try:
+        os.kill(pid,0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+# One staging area per worker process
+stages = {}
+
+def get_bids_stage(bidsroot, write_lock=None):
+
+    pid = os.getpid()
+    if pid not in stages:
+        stages[pid] = bids_stage(bidsroot,write_lock)
+
+        # Runs after the background writer (higher exit priority) has flushed its queue
+        Finalize(stages[pid], stages[pid].close, exitpriority=5)
+    return stages[pid]
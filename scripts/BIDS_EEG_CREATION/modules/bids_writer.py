@@ -0,0 +1,84 @@
+import os
+import queue
+import threading
+from multiprocessing.util import Finalize
+
+class bids_writer:
+    """
+    Background writer stage for downloaded clips.
+
+    Download code puts (handler, clip index, raw) items on a bounded queue and moves straight on to the next download,
+    while a writer thread drains the queue into BIDS_handler.save_raw. The queue depth bounds how many clips wait in
+    memory. A clip that fails to write is handed back to its handler through write_failed. A handler put with finish() gets
+    its subject map entry written once all of its clips are saved, and its report() is then put on the results queue, so the
+    caller only counts a file as done once its writes have committed.
+    """
+
+    def __init__(self, depth, results=None):
+        self.queue   = queue.Queue(maxsize=depth)
+        self.results = results
+        self.thread  = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, handler, idx, raw):
+        # Blocks while the queue is full, which keeps memory bounded when writing is slower than downloading
+        self.queue.put((handler,idx,raw))
+
+    def finish(self, handler):
+        self.queue.put((handler,None,None))
+
+    def run(self):
+
+        while True:
+            item = self.queue.get()
+            if item == None:
+                self.queue.task_done()
+                break
+
+            handler,idx,raw = item
+            try:
+                if raw is None:
+                    try:
+                        if handler.n_saved > 0:
+                            handler.update_subject_map()
+                            handler.n_saved = 0
+                    except Exception as e:
+                        handler.write_failed(None,e)
+                    if self.results != None:
+                        self.results.put(handler.report())
+                else:
+                    handler.save_raw(idx,raw)
+            except Exception as e:
+                handler.write_failed(idx,e)
+            finally:
+                del item, raw
+                self.queue.task_done()
+
+    def close(self):
+        """
+        Write everything still queued and stop the writer thread.
+        """
+
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+# One writer per worker process
+writers = {}
+
+def get_bids_writer(depth, results=None):
+
+    pid = os.getpid()
+    if pid not in writers:
+        writers[pid] = bids_writer(depth,results)
+
+        # Pool workers run their finalizers on a clean exit, so queued clips are written before the worker goes away. This
+        # runs ahead of the results queue's own finalizer (priority 10), which stops it sending anything put after it.
+        Finalize(writers[pid], writers[pid].close, exitpriority=20)
+    return writers[pid]
+
+def close_bids_writer():
+
+    pid = os.getpid()
+    if pid in writers:
+        writers.pop(pid).close()
@@ -0,0 +1,103 @@
+import os
+import hashlib
+import numpy as np
+from pathlib import Path as Pathlib
+
+class chunk_cache:
+    """
+    On-disk cache of downloaded iEEG.org data chunks.
+
+    Each chunk is stored as a .npy file keyed by (dataset, start, duration, channel set). Reads refresh the file
+    modification time, and the least recently used chunks are removed once the cache grows past its size limit.
+
+    The size of the cache is kept as a running total, so the directory is only scanned once the total goes over the limit,
+    or once this process has written another 1% of the limit since its last scan to pick up what other workers wrote.
+    Eviction goes 1% below the limit so a full cache is not scanned again on the next chunk.
+    """
+
+    def __init__(self, root, max_size_gb=100):
+        self.root     = root
+        self.max_size = int(max_size_gb*1e9)
+        self.slack    = max(1,self.max_size//100)
+        Pathlib(self.root).mkdir(parents=True, exist_ok=True)
+        self.evict()
+
+    def chunk_path(self, dataset, start, duration, channels):
+
+        # Hash the channel set so the filename stays short for high channel count recordings
+        channel_hash = hashlib.sha1(','.join(channels).encode()).hexdigest()[:16]
+        return os.path.join(self.root,f"{dataset}_{int(start)}_{int(duration)}_{channel_hash}.npy")
+
+    def get(self, dataset, start, duration, channels):
+        """
+        Return a cached chunk or None if it has not been downloaded yet.
+
+        Args:
+            dataset (str): iEEG.org dataset name
+            start (float): Start time of the chunk in microseconds
+            duration (float): Duration of the chunk in microseconds
+            channels (list): Channel labels of the request
+
+        Returns:
+            array: Memory mapped (sample, channel) array, or None.
+        """
+
+        fpath = self.chunk_path(dataset,start,duration,channels)
+        try:
+            data = np.load(fpath,mmap_mode='r')
+            os.utime(fpath)
+            return data
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+
+    def put(self, dataset, start, duration, channels, data):
+
+        # Write to a temporary name first so readers never see a partial chunk
+        fpath = self.chunk_path(dataset,start,duration,channels)
+        tpath = f"{fpath}.{os.getpid()}.tmp"
+        with open(tpath,'wb') as fp:
+            np.save(fp,data)
+        os.replace(tpath,fpath)
+
+        # Keep a running total rather than looking at the whole directory for every chunk
+        self.size  += data.nbytes
+        self.added += data.nbytes
+        if self.size > self.max_size or self.added >= self.slack:
+            self.evict()
+
+    def evict(self):
+        """
+        Scan the cache and, if it is over its size limit, remove the least recently used chunks until it is 1% under it.
+        """
+
+        entries = []
+        for entry in os.scandir(self.root):
+            if entry.name.endswith('.npy'):
+                try:
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime,stat.st_size,entry.path))
+                except FileNotFoundError:
+                    pass
+
+        total = sum([ientry[1] for ientry in entries])
+        if total > self.max_size:
+            for mtime,size,fpath in sorted(entries):
+                if total <= self.max_size-self.slack:
+                    break
+                try:
+                    os.remove(fpath)
+                except FileNotFoundError:
+                    pass
+                total -= size
+        self.size  = total
+        self.added = 0
+
+# One cache per directory in each process, so the running size count lasts for the whole run
+caches = {}
+
+def get_chunk_cache(root, max_size_gb=100):
+
+    key = (os.getpid(),root)
+    if key not in caches:
+        caches[key] = chunk_cache(root,max_size_gb)
+    return caches[key]
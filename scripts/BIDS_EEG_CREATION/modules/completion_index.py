@@ -0,0 +1,51 @@
+import numpy as np
+
+class completion_index:
+    """
+    Hash set of everything already converted, keyed by (source file, time window or 'annots', source type).
+
+    Built once from the subject ledger at startup, so deciding whether an input row still needs work is a set lookup
+    instead of a scan of the subject map.
+    """
+
+    def __init__(self, ledger):
+        self.done = set()
+        for ifile,itimes,isource in ledger.get_completed():
+            self.done.add((ifile,normalize_times(itimes),isource))
+
+    def is_done(self, orig_filename, times, source):
+
+        if (orig_filename,normalize_times(times),source) in self.done:
+            return True
+
+        # Older subject maps stored the command line window for every row of an inputs file, which was None_None. Those
+        # rows cannot tell windows apart, so count them as covering the whole file like the old skip check did.
+        return times != 'annots' and (orig_filename,'None_None',source) in self.done
+
+def window_key(start, duration):
+    """
+    Times string for a start and duration request, e.g. '0_600000000'.
+    """
+
+    return normalize_times(f"{start}_{duration}")
+
+def normalize_times(times):
+
+    # The same window can come in as ints, floats or numpy floats depending on where it was read from
+    try:
+        start,duration = [float(ival) for ival in str(times).split('_')]
+        if np.isfinite(start) and np.isfinite(duration):
+            return f"{int(start)}_{int(duration)}"
+    except ValueError:
+        pass
+    return str(times)
+
+def times_key(args, start=None, duration=None):
+    if args.annotations:
+        return 'annots'
+    return window_key(start,duration)
+
+def source_type(args):
+    if args.ieeg:
+        return 'ieeg.org'
+    return 'edf'
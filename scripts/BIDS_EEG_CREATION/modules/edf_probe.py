@@ -0,0 +1,212 @@
+import numpy as np
+
+# Physical dimensions mne reads as scaled volts
+unit_scale = {'uV':1e-6,'\u00b5V':1e-6,'\u03bcV':1e-6,'\x83\xcaV':1e-6,'mV':1e-3}
+
+# Channels mne treats as stim channels by default. They are read without a unit scaling, as integer event codes masked to
+# the low 17 bits.
+stim_labels = ['status','trigger']
+stim_mask   = 2**17-1
+
+class edf_probe:
+    """
+    Header of an EDF file, read and checked once, with the file kept open for the data stage.
+
+    The fixed size header is parsed in one read and checked against the file size. The data records are then mapped into
+    memory over the same open file, so samples are only read when they are asked for and the file never has to be opened or
+    parsed a second time. Channel labels, sample rates and physical scaling follow the mne EDF reader, stim channels
+    included, so the values come out the same as from read_raw_edf.
+    """
+
+    def __init__(self, fpath):
+        self.fpath = fpath
+        self.fid   = open(fpath,'rb')
+        try:
+            self.read_header()
+        except:
+            self.fid.close()
+            raise
+
+    def read_header(self):
+
+        fixed = self.fid.read(256)
+        if len(fixed) != 256 or fixed[:8].strip() != b'0':
+            raise ValueError(f"{self.fpath} is not an EDF file.")
+        header_bytes    = int(fixed[184:192])
+        n_records       = int(fixed[236:244])
+        record_duration = float(fixed[244:252])
+        ns              = int(fixed[252:256])
+        if ns < 1 or header_bytes != 256*(ns+1) or record_duration <= 0:
+            raise ValueError(f"{self.fpath} has an inconsistent EDF header.")
+
+        # Signal fields are stored field by field, each one repeated for every signal
+        signal_header = self.fid.read(256*ns)
+        if len(signal_header) != 256*ns:
+            raise ValueError(f"{self.fpath} has a truncated EDF header.")
+        widths = [('label',16),('transducer',80),('unit',8),('pmin',8),('pmax',8),('dmin',8),('dmax',8),('prefilter',80),
+                  ('spr',8),('reserved',32)]
+        fields = {}
+        offset = 0
+        for iname,iwidth in widths:
+            fields[iname] = [signal_header[offset+idx*iwidth:offset+(idx+1)*iwidth].decode('latin-1').split('\x00')[0].strip()
+                             for idx in range(ns)]
+            offset       += iwidth*ns
+
+        spr = np.array(fields['spr'],dtype=int)
+        if (spr < 1).any():
+            raise ValueError(f"{self.fpath} has signals without samples.")
+
+        # Only keep whole records that are actually in the file
+        self.fid.seek(0,2)
+        record_samples = int(spr.sum())
+        available      = (self.fid.tell()-header_bytes)//(2*record_samples)
+        if n_records < 0 or n_records > available:
+            n_records = available
+        if n_records < 1:
+            raise ValueError(f"{self.fpath} has no data records.")
+
+        # Annotation signals are not data channels
+        self.signals         = [idx for idx in range(ns) if fields['label'][idx] not in ('EDF Annotations','BDF Annotations')]
+        self.header_bytes    = header_bytes
+        self.record_samples  = record_samples
+        self.record_offsets  = np.concatenate(([0],np.cumsum(spr)))
+        self.samples         = spr[self.signals]
+        self.n_records       = n_records
+        self.record_duration = record_duration
+        self.duration        = n_records*record_duration
+        self.sample_rates    = self.samples/record_duration
+        self.mixed_rates     = np.unique(self.samples).size > 1
+        self.channels        = unique_labels([fields['label'][idx] for idx in self.signals])
+        self.units           = [fields['unit'][idx] for idx in self.signals]
+
+        # Digital to physical scaling, with the same guards against degenerate ranges as mne
+        pmin   = np.array(fields['pmin'],dtype=float)[self.signals]
+        pmax   = np.array(fields['pmax'],dtype=float)[self.signals]
+        dmin   = np.array(fields['dmin'],dtype=float)[self.signals]
+        dmax   = np.array(fields['dmax'],dtype=float)[self.signals]
+        drange = dmax-dmin
+        drange[drange==0] = 1
+        prange = pmax-pmin
+        prange[prange==0] = 1
+        self.cal     = prange/drange
+        self.offset  = pmin-dmin*self.cal
+        self.stim    = np.array([ichannel.lower() in stim_labels for ichannel in self.channels],dtype=bool)
+        self.gain    = np.array([1.0 if istim else unit_scale.get(iunit,1.0) for istim,iunit in zip(self.stim,self.units)])
+        self.records = np.memmap(self.fid,dtype='<i2',mode='r',offset=header_bytes,shape=(n_records,record_samples))
+
+    @property
+    def fs(self):
+        return float(self.sample_rates[0])
+
+    @property
+    def n_samples(self):
+        return self.n_records*int(self.samples[0])
+
+    def read(self, start_record=0, stop_record=None, chunk_bytes=2**26):
+        """
+        Read whole data records as physical values.
+
+        Args:
+            start_record (int, optional): First record to read.
+            stop_record (int, optional): Record to stop before. Defaults to the end of the file.
+            chunk_bytes (int, optional): Size of the contiguous reads the records are pulled in with.
+
+        Returns:
+            array: Values in volts, shaped (channels, samples).
+        """
+
+        if self.mixed_rates:
+            raise ValueError(f"{self.fpath} has mixed sampling rates and cannot be read into a single array.")
+        if stop_record == None:
+            stop_record = self.n_records
+
+        spr     = int(self.samples[0])
+        n_read  = stop_record-start_record
+        data    = np.empty((len(self.signals),n_read*spr))
+        n_chunk = max(1,chunk_bytes//(2*self.record_samples))
+        for r0 in range(start_record,stop_record,n_chunk):
+            r1    = min(r0+n_chunk,stop_record)
+            chunk = np.array(self.records[r0:r1])
+            i0,i1 = (r0-start_record)*spr,(r1-start_record)*spr
+            for idx,isig in enumerate(self.signals):
+                out = data[idx,i0:i1].reshape((r1-r0,spr))
+                self.scale(idx,chunk[:,self.record_offsets[isig]:self.record_offsets[isig+1]],out)
+        return data
+
+    def scale(self, idx, digital, out):
+        """
+        Convert the digital values of one channel to physical values in out, in the same order of operations as mne.
+        """
+
+        np.multiply(digital,self.cal[idx],out=out)
+        out += self.offset[idx]
+        out *= self.gain[idx]
+        if self.stim[idx]:
+            out[:] = np.bitwise_and(out.astype(int),stim_mask)
+
+    def read_samples(self, start, stop):
+        """
+        Read a range of samples as physical values, pulling in only the records that hold them.
+
+        Returns:
+            array: Values in volts, shaped (channels, stop-start).
+        """
+
+        spr    = int(self.samples[0])
+        r0,r1  = start//spr,-(-stop//spr)
+        offset = start-r0*spr
+        return self.read(r0,r1)[:,offset:offset+stop-start]
+
+    def extremes(self, chunk_bytes=2**26):
+        """
+        Smallest and largest physical value of every channel, found from the digital values without scaling the data.
+
+        Returns:
+            array: Minimum of each channel in volts.
+            array: Maximum of each channel in volts.
+        """
+
+        dmins   = np.full(len(self.signals),np.iinfo(np.int16).max,dtype=np.int16)
+        dmaxs   = np.full(len(self.signals),np.iinfo(np.int16).min,dtype=np.int16)
+        n_chunk = max(1,chunk_bytes//(2*self.record_samples))
+        for r0 in range(0,self.n_records,n_chunk):
+            chunk = np.array(self.records[r0:r0+n_chunk])
+            for idx,isig in enumerate(self.signals):
+                ichunk     = chunk[:,self.record_offsets[isig]:self.record_offsets[isig+1]]
+                dmins[idx] = min(dmins[idx],ichunk.min())
+                dmaxs[idx] = max(dmaxs[idx],ichunk.max())
+
+        # Scale the extremes the same way read does, so they match the data exactly. A negative calibration flips them.
+        lows  = (dmins*self.cal+self.offset)*self.gain
+        highs = (dmaxs*self.cal+self.offset)*self.gain
+        mins  = np.minimum(lows,highs)
+        maxs  = np.maximum(lows,highs)
+
+        # The event code mask does not keep the order of the values, so stim channels are scaled in full
+        for idx in np.flatnonzero(self.stim):
+            mins[idx],maxs[idx] = np.inf,-np.inf
+            isig                = self.signals[idx]
+            for r0 in range(0,self.n_records,n_chunk):
+                ichunk    = np.array(self.records[r0:r0+n_chunk,self.record_offsets[isig]:self.record_offsets[isig+1]])
+                out       = np.empty(ichunk.shape)
+                self.scale(idx,ichunk,out)
+                mins[idx] = min(mins[idx],out.min())
+                maxs[idx] = max(maxs[idx],out.max())
+        return mins,maxs
+
+    def close(self):
+        self.records = None
+        self.fid.close()
+
+def unique_labels(labels):
+    """
+    Number repeated channel labels the way mne does, e.g. two 'EKG' channels become 'EKG-0' and 'EKG-1'.
+    """
+
+    labels = list(labels)
+    for ilabel in set(labels):
+        overlaps = [idx for idx,jlabel in enumerate(labels) if jlabel == ilabel]
+        if len(overlaps) > 1:
+            for count,idx in enumerate(overlaps):
+                labels[idx] = f"{ilabel}-{count}"
+    return labels
@@ -0,0 +1,218 @@
+import math
+import numpy as np
+from mne.defaults import DEFAULTS
+
+# Channel types MNE keeps in volts. The EDF export writes these in microvolts.
+volt_scale = dict((k,1e6) for k,v in DEFAULTS['si_units'].items() if v == 'V')
+
+# Largest digital value of the symmetric 16 bit range
+digital_max = 32767
+
+# Digital range of the EDF+ annotation signal. Its physical range is set to the same values.
+annotation_range = (-32768,32767)
+
+def header_field(value, length):
+    """
+    Left justified ASCII header field, as laid out by the EDF specification.
+    """
+
+    value = str(value)
+    if len(value) > length or not value.isprintable():
+        raise ValueError(f"{value!r} does not fit an EDF header field of {length} characters")
+    return value.encode('ascii').ljust(length)
+
+def float_field(value):
+
+    # Whole numbers are written without a decimal point
+    value = float(value)
+    if value.is_integer():
+        value = int(value)
+    return header_field(value,8)
+
+def round_to_field(value, round_func):
+    """
+    Round a physical limit outwards (round_func is math.floor or math.ceil) so it fits the 8 characters of its header field.
+    """
+
+    value = float(value)
+    if value.is_integer():
+        return value
+    integer_length = str(value).find('.')
+    if integer_length == 8:
+        return round_func(value)
+    factor = 10**(8-1-integer_length)
+    return round_func(value*factor)/factor
+
+def annotation_tal(onset, duration=None, text=''):
+    """
+    EDF+ time-stamped annotation list entry. Onsets and durations use the shortest string that reads back as the same float.
+    """
+
+    timing = np.format_float_positional(onset, unique=True, trim='-', sign=True)
+    if duration != None:
+        timing += '\x15'+np.format_float_positional(duration, unique=True, trim='-')
+    return f"{timing}\x14{text}\x14".encode()
+
+class edf_layout:
+    """
+    Header and data record layout for one EDF+C clip with 1 second data records, made the way mne.export makes them when
+    mne_bids converts a RawArray to EDF (microvolt scaling, physical range per channel type, symmetric 16 bit digital range,
+    edge padding of a partial last record marked as BAD_ACQ_SKIP, anonymous patient and recording fields).
+
+    Args:
+        n_samples (int): Number of real samples per channel.
+        fs (float): Sampling frequency. Must be a whole number of Hz.
+        channels (list): Channel labels
+        channel_types (list): mne channel type of each channel
+        mins (array): Smallest value of each channel in volts.
+        maxs (array): Largest value of each channel in volts.
+    """
+
+    def __init__(self, n_samples, fs, channels, channel_types, mins, maxs):
+
+        channel_types = np.array(channel_types)
+        self.fs       = int(fs)
+        self.scale    = np.array([volt_scale.get(itype,1.0) for itype in channel_types])
+        units         = ['uV' if itype in volt_scale and itype != 'stim' else '' for itype in channel_types]
+
+        # Physical range of each channel type. Scaling by a positive constant keeps the order, so the extremes of the scaled
+        # data are the scaled extremes, and the data itself only has to be scaled once.
+        mins = mins*self.scale
+        maxs = maxs*self.scale
+        if not (np.isfinite(mins).all() and np.isfinite(maxs).all()):
+            raise ValueError("Signal data must contain only finite values")
+        physical_ranges = np.zeros((len(channels),2))
+        for itype in np.unique(channel_types):
+            mask                  = (channel_types==itype)
+            physical_ranges[mask] = mins[mask].min(),maxs[mask].max()
+        flat = (physical_ranges[:,0]==physical_ranges[:,1])
+        physical_ranges[flat,1] += 1
+
+        # The gain and offset come from the physical range as it is rounded into the header
+        physical_mins = [float_field(round_to_field(ival,math.floor)) for ival in physical_ranges[:,0]]
+        physical_maxs = [float_field(round_to_field(ival,math.ceil)) for ival in physical_ranges[:,1]]
+        pmins         = np.array([float(ival) for ival in physical_mins])
+        pmaxs         = np.array([float(ival) for ival in physical_maxs])
+        self.gain     = (pmaxs-pmins)/(2*digital_max)
+        self.offset   = pmaxs/self.gain-digital_max
+
+        # EDF needs whole data records, so a partial last second is padded with the edge values and marked as skipped
+        self.n_samples   = n_samples
+        self.n_records   = int(np.ceil(n_samples/self.fs))
+        self.annotations = self.annotation_records(self.n_records*self.fs-n_samples)
+
+        # Header record, one field at a time for every signal. The annotation signal comes last.
+        n_signals = len(channels)+1
+        prefilter = f"HP:0.0Hz LP:{fs/2}Hz"
+        fields    = [header_field('0',8), header_field('X X X X',80), header_field('Startdate X X X X',80),
+                     header_field('01.01.85',8), header_field('00.00.00',8), header_field(256*(n_signals+1),8),
+                     header_field('EDF+C',44), header_field(self.n_records,8), float_field(1), header_field(n_signals,4)]
+        signal_fields = [[header_field(ichannel,16) for ichannel in channels]+[header_field('EDF Annotations ',16)],
+                         [header_field('',80)]*n_signals,
+                         [header_field(iunit,8) for iunit in units]+[header_field('',8)],
+                         physical_mins+[float_field(annotation_range[0])],
+                         physical_maxs+[float_field(annotation_range[1])],
+                         [float_field(-digital_max)]*len(channels)+[float_field(annotation_range[0])],
+                         [float_field(digital_max)]*len(channels)+[float_field(annotation_range[1])],
+                         [header_field(prefilter,80)]*len(channels)+[header_field('',80)],
+                         [header_field(self.fs,8)]*len(channels)+[header_field(self.annotations.shape[1]//2,8)],
+                         [header_field('',32)]*n_signals]
+        for ifield in signal_fields:
+            fields.extend(ifield)
+        self.header = b"".join(fields)
+
+    def annotation_records(self, pad_width):
+        """
+        Annotation signal bytes of every data record, shaped (records, bytes). Each record starts with its timekeeping entry,
+        and the BAD_ACQ_SKIP entry for the padding goes in the last record.
+        """
+
+        records = [annotation_tal(float(irecord))+b"\x00" for irecord in range(self.n_records)]
+        if pad_width > 0:
+            onset        = (self.n_samples-1)/self.fs+1/self.fs
+            records[-1] += annotation_tal(onset,pad_width/self.fs,'BAD_ACQ_SKIP')+b"\x00"
+        maxlen = 2*int(np.ceil(max([len(irecord) for irecord in records])/2))
+        return np.frombuffer(b"".join([irecord.ljust(maxlen,b"\x00") for irecord in records]),dtype=np.uint8).reshape((self.n_records,maxlen))
+
+    def encode(self, block):
+        """
+        Scale a block of physical values (volts, channels first) to digital values. The block is scaled in place.
+        """
+
+        block *= self.scale[:,None]
+        block /= self.gain[:,None]
+        block -= self.offset[:,None]
+        return np.round(block,out=block).astype('<i2')
+
+    def write(self, fpath, read_samples, block_samples):
+        """
+        Write the header, then the data records a block at a time, so only one block of samples is held in memory.
+
+        Args:
+            fpath (str): Output path
+            read_samples (callable): Returns samples [start,stop) of every channel in volts, shaped (channels, stop-start).
+                                     The block returned is scaled in place.
+            block_samples (int): Number of samples per channel read and written at a time. Rounded to whole records.
+        """
+
+        n_block = max(1,block_samples//self.fs)
+        with open(fpath,'wb') as fid:
+            fid.write(self.header)
+            for r0 in range(0,self.n_records,n_block):
+                r1    = min(r0+n_block,self.n_records)
+                block = self.encode(read_samples(r0*self.fs,min(r1*self.fs,self.n_samples)))
+                if block.shape[1] < (r1-r0)*self.fs:
+                    block = np.pad(block,((0,0),(0,(r1-r0)*self.fs-block.shape[1])),mode='edge')
+
+                # A data record holds a second of every signal in turn, followed by its annotations
+                records = block.reshape((block.shape[0],r1-r0,self.fs)).transpose(1,0,2)
+                records = np.ascontiguousarray(records).view(np.uint8).reshape((r1-r0,-1))
+                np.hstack((records,self.annotations[r0:r1])).tofile(fid)
+
+def check_fs(fs):
+
+    fs = float(fs)
+    if not fs.is_integer():
+        raise ValueError(f"Direct EDF writes need an integer sampling frequency, got {fs}.")
+    return fs
+
+def write_edf(fpath, data, fs, channels, channel_types, block_samples=2**20):
+    """
+    Encode a channels-first array of physical values straight to an EDF file.
+
+    The samples and header come out the same as from mne.export (see edf_layout). The float to int16 scaling runs over
+    blocks of samples, so only one block is copied on top of the input buffer.
+
+    Args:
+        fpath (str): Output path
+        data (array): Physical values in volts, shaped (channels, samples).
+        fs (float): Sampling frequency. Must be a whole number of Hz.
+        channels (list): Channel labels
+        channel_types (list): mne channel type of each channel
+        block_samples (int, optional): Number of samples per channel scaled at a time.
+    """
+
+    fs     = check_fs(fs)
+    layout = edf_layout(data.shape[1],fs,channels,channel_types,data.min(axis=1),data.max(axis=1))
+    layout.write(fpath,lambda i0,i1: data[:,i0:i1].copy(),block_samples)
+
+def stream_edf(fpath, read_samples, n_samples, fs, channels, channel_types, mins, maxs, block_samples):
+    """
+    Encode a recording to an EDF file a block of samples at a time, so peak memory is set by the block size rather than the
+    length of the recording. The file comes out byte for byte the same as from write_edf.
+
+    Args:
+        fpath (str): Output path
+        read_samples (callable): Returns samples [start,stop) of every channel in volts, shaped (channels, stop-start).
+        n_samples (int): Number of samples per channel.
+        fs (float): Sampling frequency. Must be a whole number of Hz.
+        channels (list): Channel labels
+        channel_types (list): mne channel type of each channel
+        mins (array): Smallest value of each channel in volts.
+        maxs (array): Largest value of each channel in volts.
+        block_samples (int): Number of samples per channel read and written at a time. Rounded to whole records.
+    """
+
+    fs     = check_fs(fs)
+    layout = edf_layout(n_samples,fs,channels,channel_types,mins,maxs)
+    layout.write(fpath,read_samples,block_samples)
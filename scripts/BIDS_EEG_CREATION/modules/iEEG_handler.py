@@ -1,59 +1,97 @@
+import queue
+import random
 import numpy as np
 import pandas as PD
-from os import path
 from tqdm import tqdm
 from time import sleep
-from ieeg.auth import Session
+from os import getpid
+from pathlib import Path as Pathlib
+from mne_bids import make_dataset_description
 
 # Multicore support
 import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
 
 # Local imports
+from modules.chunk_cache import get_chunk_cache
+from modules.rate_limiter import rate_limiter
 from modules.BIDS_handler import BIDS_handler
+from modules.bids_writer import get_bids_writer, close_bids_writer
+from modules.session_pool import get_session_pool
+from modules.subject_ledger import get_subject_ledger
+from modules.completion_index import completion_index, times_key, source_type
+from modules.metadata_cache import get_metadata_cache, metadata_path
 
 # Allows us to catch ieeg api errors
 import ieeg.ieeg_api as IIA
-from requests.exceptions import ReadTimeout as RTIMEOUT
+from requests.exceptions import Timeout as RTIMEOUT
+from requests.exceptions import ConnectionError as RCONNECTION
 
 # API timeout class
 import signal
+import threading
 class TimeoutException(Exception):
     pass
 
 class Timeout:
-    def __init__(self, seconds=1, multiflag=False, error_message='Function call timed out'):
-        self.seconds       = seconds
+    """
+    Raise a TimeoutException if the wrapped call runs for too long.
+
+    Uses SIGALRM, which is only available on the main thread of a process. That includes multiprocessing pool workers.
+    Anywhere else the alarm is skipped and we rely on the per-request socket timeouts set on the session pool.
+    """
+
+    def __init__(self, seconds=1, error_message='Function call timed out'):
+        self.seconds       = max(1,int(np.ceil(seconds)))
         self.error_message = error_message
-        self.multiflag     = multiflag
+        self.alarmflag     = threading.current_thread() is threading.main_thread()
 
     def handle_timeout(self, signum, frame):
         raise TimeoutException(self.error_message)
 
     def __enter__(self):
-        if not self.multiflag:
+        if self.alarmflag:
             signal.signal(signal.SIGALRM, self.handle_timeout)
             signal.alarm(self.seconds)
-        else:
-            pass
 
     def __exit__(self, exc_type, exc_value, traceback):
-        if not self.multiflag:
+        if self.alarmflag:
             signal.alarm(0)
-        else:
-            pass
 
 class iEEG_download(BIDS_handler):
 
-    def __init__(self, args, write_lock):
+    def __init__(self, args, write_lock, limiter=None, write_results=None):
         
         # Store variables based on input params
         self.args           = args
         self.subject_path   = args.bidsroot+args.subject_file
         self.write_lock     = write_lock
+        self.limiter        = limiter
+        self.success_flag   = False
+        self.write_errors   = 0
+        self.pending_write  = False
+
+        # Optional background writer stage shared by every download in this worker. It reports each file on write_results
+        # once its writes are done.
+        if args.pipeline_depth > 0:
+            self.writer = get_bids_writer(args.pipeline_depth,write_results)
+        else:
+            self.writer = None
+        self.pool           = get_session_pool(args.username,args.password,args.chunk_concurrency,args.request_timeout,limiter)
+        self.metadata       = get_metadata_cache(metadata_path(self.subject_path))
+
+        # Optional on-disk cache so reruns only fetch the chunks we do not already have
+        if args.chunk_cache != None:
+            self.cache = get_chunk_cache(args.chunk_cache,args.chunk_cache_size)
+        else:
+            self.cache = None
 
         # Hard coded variables based on ieeg api
         self.n_retry        = 3
-        self.global_timeout = 60
+        self.base_backoff   = 5
+        self.max_backoff    = 120
+        self.global_timeout = args.request_timeout
+        self.time_cutoff    = int(10*60*1e6)
         self.clip_layer     = 'EEG clip times'
         self.natus_layer    = 'Imported Natus ENT annotations'
 
@@ -73,34 +111,34 @@ class iEEG_download(BIDS_handler):
                 self.clips = self.clips[1:]
 
             # Manage edge cases
+            clip_vals = [iclip.start_time_offset_usec for iclip in self.clips]
             if self.clips[0].type.lower() == 'clip end':
-                self.clips = list(np.concatenate(([0],self.clips), axis=0))
+                clip_vals.insert(0,0)
             if self.clips[-1].type.lower() == 'clip start':
-                self.clips = list(np.concatenate((self.clips,[self.end_time-self.start_time]), axis=0))
-
-            clip_vals = []
-            for iclip in self.clips:
-                try:
-                    clip_vals.append(iclip.start_time_offset_usec)
-                except AttributeError:
-                    clip_vals.append(iclip)
+                clip_vals.append(self.end_time-self.start_time)
 
             # Turn the clip times into start and end arrays
-            self.clip_start_times = np.array([iclip for iclip in clip_vals[::2]])
-            self.clip_end_times   = np.array([iclip for iclip in clip_vals[1::2]])
+            clip_vals             = np.array(clip_vals,dtype=np.int64)
+            self.clip_start_times = clip_vals[::2]
+            self.clip_end_times   = clip_vals[1::2]
             self.clip_durations   = self.clip_end_times-self.clip_start_times
 
-            # Match the annotations to the clips
+            # Match the annotations to the clips. Clips do not overlap, so each annotation can only fall in the last clip starting before it.
+            times       = np.array([annot.start_time_offset_usec for annot in self.raw_annotations],dtype=np.int64)
+            clip_order  = np.argsort(self.clip_start_times,kind='stable')
+            sorted_inds = np.searchsorted(self.clip_start_times[clip_order],times,side='right')-1
+            clip_inds   = clip_order[np.clip(sorted_inds,0,None)]
+            matched     = (sorted_inds>=0)&(times<=self.clip_end_times[clip_inds])
+
+            # Build the per clip offset dictionaries from the matched annotations only
             self.annotations      = {ival:{} for ival in range(self.clip_start_times.size)}
             self.annotation_flats = []
-            for annot in self.raw_annotations:
-                time = annot.start_time_offset_usec
-                desc = annot.description
-                for idx, istart in enumerate(self.clip_start_times):
-                    if (time >= istart) and (time <= self.clip_end_times[idx]):
-                        event_time_shift = (time-istart)
-                        self.annotations[idx][event_time_shift] = desc
-                        self.annotation_flats.append(desc)
+            for iannot in np.flatnonzero(matched):
+                idx              = int(clip_inds[iannot])
+                desc             = self.raw_annotations[iannot].description
+                event_time_shift = int(times[iannot]-self.clip_start_times[idx])
+                self.annotations[idx][event_time_shift] = desc
+                self.annotation_flats.append(desc)
 
     def download_by_cli(self, uid, file, target, start, duration, proposed_sub, file_idx):
 
@@ -111,6 +149,8 @@ class iEEG_download(BIDS_handler):
         self.success_flag = False
         self.proposed_sub = proposed_sub
         self.file_idx     = file_idx
+        self.start        = start
+        self.duration     = duration
 
         # Loop over clips
         BIDS_handler.__init__(self)
@@ -120,6 +160,12 @@ class iEEG_download(BIDS_handler):
             BIDS_handler.make_info(self)
             BIDS_handler.add_raw(self)
 
+            # Hand the clip to the writer stage and move on to the next download
+            if self.writer != None:
+                self.queue_raw()
+                self.finish_writes()
+                return
+
         # Save the bids files if we have any data
         try:
             if len(self.raws) > 0:
@@ -128,7 +174,7 @@ class iEEG_download(BIDS_handler):
             print(e)
             pass
 
-    def download_by_annotation(self, uid, file, target, proposed_sub):
+    def download_by_annotation(self, uid, file, target, proposed_sub, windows=None):
 
         # Store the ieeg filename
         self.uid          = uid
@@ -143,21 +189,85 @@ class iEEG_download(BIDS_handler):
         # Loop over clips
         if self.success_flag == True:
             BIDS_handler.__init__(self)
+            BIDS_handler.event_mapper(self)
             for idx,istart in tqdm(enumerate(self.clip_start_times), desc="Downloading Clip Data", total=len(self.clip_start_times), leave=False, disable=self.args.multithread):
+
+                # When replaying failures, only download the clips that failed before
+                if isinstance(windows,set) and int(istart) not in windows:
+                    continue
+
                 self.session_method_handler(istart, self.clip_durations[idx])
                 if self.success_flag == True:
                     BIDS_handler.get_channel_type(self)
                     BIDS_handler.make_info(self)
-                    BIDS_handler.add_raw(self)
+                    BIDS_handler.add_raw(self,idx)
 
-        # Save the bids files if we have any data
+                    # In streaming mode each clip is written as soon as it is downloaded instead of holding the whole admission.
+                    # With a writer stage the write happens in the background while the next clip downloads.
+                    if self.writer != None:
+                        self.queue_raw()
+                    elif self.args.stream:
+                        BIDS_handler.stream_raw(self)
+
+            # The writer records the file in the subject map after its last queued clip
+            if self.writer != None:
+                self.finish_writes()
+                return
+
+        # Save the bids files if we have any data, and record the file once any clip was written
         try:
-            if len(self.raws) > 0:
-                BIDS_handler.event_mapper(self)
+            if len(self.raws) > 0 or self.n_saved > 0:
                 BIDS_handler.save_bids(self)
         except AttributeError as e:
             pass
 
+    def queue_raw(self):
+
+        # Pass ownership of the newest clip to the writer stage so this worker only keeps the next download in memory
+        self.writer.put(self,self.raw_idx.pop(),self.raws.pop())
+        self.data = None
+
+    def finish_writes(self):
+
+        # The writer reports the file once its last clip is written
+        self.pending_write = True
+        self.writer.finish(self)
+
+    def write_failed(self, idx, e):
+        """
+        Log a clip the writer stage could not write like a failed download, so --retry_failures fetches it again.
+
+        Args:
+            idx (int): Clip index, or None if recording the file in the subject map failed.
+            e (Exception): Error raised by the write
+        """
+
+        print(f"Unable to write {self.current_file}: {e}")
+        self.write_errors += 1
+        if not hasattr(self,'clip_start_times'):
+            self.log_failure(self.start,self.duration,e)
+        elif idx != None:
+            self.log_failure(self.clip_start_times[idx],self.clip_durations[idx],e)
+        else:
+            self.log_failure(-1,-1,e)
+
+    def report(self):
+        """
+        Returns:
+            dict: Input row of the file and whether every download and write of it succeeded.
+        """
+
+        status = 'downloaded' if self.success_flag and self.write_errors == 0 else 'failed'
+        return {'idx':self.input_idx,'file':self.current_file,'status':status}
+
+    def log_failure(self, start, duration, e):
+
+        # Each call is logged along with the input row the window came from, which sets its run number on a replay
+        file_idx = getattr(self,'file_idx',-1)
+        fp = open(self.args.bidsroot+self.args.failure_file,"a")
+        fp.write(f"{self.uid},{self.current_file},{start},{duration},{self.target},{file_idx},'{e}'\n")
+        fp.close()
+
     def session_method_handler(self,start,duration,annotation_flag=False):
         """
         Wrapper to call ieeg. Due to ieeg errors, we want to make sure we can try to call it a few times before giving up.
@@ -168,24 +278,56 @@ class iEEG_download(BIDS_handler):
             annotation_flag (bool, optional): Flag whether we just want annotation data or not. Defaults to False.
         """
 
+        # Every request has its own socket timeout. The overall limit allows for each round of concurrent chunk requests to use it up.
+        if annotation_flag:
+            call_timeout = self.global_timeout
+            n_requests   = 2
+        else:
+            n_chunks     = np.ceil(duration/self.time_cutoff)
+            call_timeout = self.global_timeout*max(1,np.ceil(n_chunks/self.args.chunk_concurrency))
+            n_requests   = int(n_chunks)
+
         n_attempts = 0
         while True:
-            with Timeout(self.global_timeout,self.args.multithread):
-                try:
+            try:
+                # Wait for the shared rate limit before the clock starts, so a throttled run slows down instead of timing out
+                if self.limiter != None:
+                    self.limiter.acquire(n_requests)
+                with Timeout(call_timeout):
                     self.session_method(start,duration,annotation_flag)
-                    self.success_flag = True
+                self.success_flag = True
+                if self.limiter != None:
+                    self.limiter.reward()
+                break
+            except (IIA.IeegConnectionError,IIA.IeegServiceError,TimeoutException,RTIMEOUT,RCONNECTION,TypeError) as e:
+
+                # Assume the session went stale and reconnect on the next attempt
+                self.pool.reset()
+                if n_attempts<self.n_retry:
+                    sleep(self.backoff(n_attempts))
+                    n_attempts += 1
+                else:
+                    print(f"Error: {e}")
+                    self.success_flag = False
+                    # Annotation calls are logged with the same -1 start/duration used for annotation inputs
+                    if annotation_flag:
+                        start,duration = -1,-1
+                    self.log_failure(start,duration,e)
                     break
-                except (IIA.IeegConnectionError,IIA.IeegServiceError,TimeoutException,RTIMEOUT,TypeError) as e:
-                    if n_attempts<self.n_retry:
-                        sleep(5)
-                        n_attempts += 1
-                    else:
-                        print(f"Error: {e}")
-                        self.success_flag = False
-                        fp = open(self.args.bidsroot+self.args.failure_file,"a")
-                        fp.write(f"{self.uid},{self.current_file},{start},{duration},{self.target},'{e}'\n")
-                        fp.close()
-                        break
+
+    def backoff(self,n_attempts):
+        """
+        Exponential backoff with jitter, so workers that failed together do not retry together.
+
+        Args:
+            n_attempts (int): Number of attempts made so far
+
+        Returns:
+            float: Seconds to wait before the next attempt
+        """
+
+        wait_time = min(self.max_backoff,self.base_backoff*2**n_attempts)
+        return wait_time*random.uniform(0.5,1)
 
     def session_method(self,start,duration,annotation_flag):
         """
@@ -200,53 +342,107 @@ class iEEG_download(BIDS_handler):
             IndexError: If there are multiple sampling frequencies, bids does not readily support this. Alerts user and stops.
         """
 
-        with Session(self.args.username,self.args.password) as session:
-            
-            # Open dataset session
-            dataset = session.open_dataset(self.current_file)
-            
-            # Logic gate for annotation call (faster, no time data needed) or get actual data
-            if not annotation_flag:
-
-                # Get the channel names and integer representations for data call
-                self.channels = dataset.ch_labels
-                channel_cntr  = list(range(len(self.channels)))
-
-                # If duration is greater than 10 min, break up the call. Make array of start,duration with max 10 min each chunk
-                time_cutoff = int(10*60*1e6)
-                end_time    = start+duration
-                ival        = start
-                chunks      = []
-                while ival < end_time:
-                    if ival+time_cutoff >= end_time:
-                        chunks.append([ival,end_time-ival])
-                    else:
-                        chunks.append([ival,time_cutoff])
-                    ival += time_cutoff
-
-                # Call data and concatenate calls if greater than 10 min
-                self.data   = []
-                for ival in chunks:
-                    self.data.append(dataset.get_data(ival[0],ival[1],channel_cntr))
-                if len(self.data) > 1:
-                    self.data = np.concatenate(self.data)
-                else:
-                    self.data = self.data[0]
-                
-                # Get the samping frequencies
-                self.fs = [dataset.get_time_series_details(ichannel).sample_rate for ichannel in self.channels]
-
-                # Data quality checks before saving
-                if np.unique(self.fs).size == 1:
-                    self.fs = self.fs[0]
-                else:
-                    raise IndexError("Too many unique values for sampling frequency.")
+        # Get the dataset from the worker session pool
+        dataset = self.pool.get_dataset(self.current_file)
+
+        # Logic gate for annotation call (faster, no time data needed) or get actual data
+        if not annotation_flag:
+
+            # Get the channel names, integer representations for data call, and samping frequencies. Looked up once per dataset.
+            metadata      = self.metadata.get(self.current_file,dataset,self.write_lock)
+            self.channels = metadata['channels']
+            channel_cntr  = list(range(len(self.channels)))
+
+            # Data quality checks before downloading. The writer stage reads self.fs while the next clip downloads, so it
+            # is only ever set to a single value.
+            if np.unique(metadata['sample_rates']).size == 1:
+                self.fs = metadata['sample_rates'][0]
             else:
-                self.clips           = dataset.get_annotations(self.clip_layer)
-                self.raw_annotations = dataset.get_annotations(self.natus_layer)
-                self.start_time      = dataset.start_time
-                self.end_time        = dataset.end_time
-            session.close()
+                raise IndexError("Too many unique values for sampling frequency.")
+
+            # If duration is greater than 10 min, break up the call. Make array of start,duration with max 10 min each chunk
+            time_cutoff = self.time_cutoff
+            end_time    = start+duration
+            ival        = start
+            chunks      = []
+            while ival < end_time:
+                if ival+time_cutoff >= end_time:
+                    chunks.append([ival,end_time-ival])
+                else:
+                    chunks.append([ival,time_cutoff])
+                ival += time_cutoff
+
+            # Work out where each chunk lands in the output so every call writes straight into one channels-first array
+            offsets   = [int(round(1e-6*(ival[0]-start)*self.fs)) for ival in chunks]
+            offsets.append(int(round(1e-6*duration*self.fs)))
+            self.data = np.empty((len(self.channels),offsets[-1]))
+            self.fetch_chunks(dataset,chunks,channel_cntr,offsets)
+
+        else:
+            self.clips           = dataset.get_annotations(self.clip_layer)
+            self.raw_annotations = dataset.get_annotations(self.natus_layer)
+            self.start_time      = dataset.start_time
+            self.end_time        = dataset.end_time
+
+    def fetch_chunks(self,dataset,chunks,channel_cntr,offsets):
+        """
+        Request the data chunks with up to --chunk_concurrency requests in flight at once, writing each one into self.data.
+
+        Args:
+            dataset (ieeg.dataset.Dataset): Open dataset to request data from
+            chunks (list): List of [start,duration] pairs in microseconds
+            channel_cntr (list): Integer channel indices to request
+            offsets (list): Sample offset of each chunk in self.data, followed by the total number of samples
+        """
+
+        # Bind the output array now. A request abandoned after a timeout may still finish later and must not touch the next attempt's array.
+        data = self.data
+
+        def fetch(idx):
+
+            # Reuse chunks that an earlier attempt or run already downloaded
+            idata = None
+            if self.cache != None:
+                idata = self.cache.get(self.current_file,chunks[idx][0],chunks[idx][1],self.channels)
+            if idata is None:
+                idata = dataset.get_data(chunks[idx][0],chunks[idx][1],channel_cntr)
+                if self.cache != None:
+                    self.cache.put(self.current_file,chunks[idx][0],chunks[idx][1],self.channels,idata)
+
+            # Each request writes into its own slot of the preallocated (channel, sample) array
+            i0    = offsets[idx]
+            i1    = min(offsets[idx+1],i0+idata.shape[0])
+            data[:,i0:i1]             = idata[:i1-i0].T
+            data[:,i1:offsets[idx+1]] = np.nan
+
+        n_workers = max(1,min(self.args.chunk_concurrency,len(chunks)))
+        if n_workers == 1:
+            for idx in range(len(chunks)):
+                fetch(idx)
+            return
+
+        # Stop handing out new chunks as soon as one of them fails so the retry logic can take over. Never block on a hung
+        # request when leaving, the socket timeout will end it in the background.
+        executor = ThreadPoolExecutor(max_workers=n_workers)
+        try:
+            futures = [executor.submit(fetch,idx) for idx in range(len(chunks))]
+            done, pending = wait(futures,return_when=FIRST_EXCEPTION)
+            for future in done:
+                future.result()
+        finally:
+            executor.shutdown(wait=False,cancel_futures=True)
+
+# Worker process state for the multicore pull. Set once per worker by the pool initializer so each task only ships a file index.
+worker_handler = None
+
+def init_worker(handler, write_lock, write_results):
+    global worker_handler
+    handler.write_lock    = write_lock
+    handler.write_results = write_results
+    worker_handler        = handler
+
+def pull_worker(file_idx):
+    return worker_handler.pull_file(file_idx)
 
 class ieeg_handler:
 
@@ -257,93 +453,224 @@ class ieeg_handler:
         self.start_times  = input_data['start'].values
         self.durations    = input_data['duration'].values
         self.proposed_sub = input_data['proposed_subnum'].values
+        self.write_lock   = None
 
-        # Get list of files to skip that already exist locally
-        subject_path = self.args.bidsroot+self.args.subject_file
-        if path.exists(subject_path):
-            self.subject_cache   = PD.read_csv(subject_path)
-            self.processed_files = self.subject_cache['orig_filename'].values
-            self.processed_times = self.subject_cache['times'].values
+        # Queue the writer stage reports each file on once its writes are done. Only made when there is a writer stage.
+        self.write_results = None
+        self.write_reports = {}
+
+        # Shared by every worker, so it is made before any of them start
+        self.limiter = rate_limiter(args.max_request_rate)
+
+        # Clip start times to restrict annotation downloads to. Only set when replaying failures.
+        if 'windows' in input_data.columns:
+            self.windows = input_data['windows'].values
+        else:
+            self.windows = [None for ifile in self.input_files]
+
+        # Input row each window was first listed on. Replayed windows keep it so they are written to their original run.
+        if 'file_idx' in input_data.columns:
+            self.file_indices = input_data['file_idx'].values.astype(int)
         else:
-            self.processed_files = []
-            self.processed_times = []
+            self.file_indices = np.arange(self.input_files.size)
+
+        # Everything converted by earlier runs, loaded once
+        self.index = completion_index(get_subject_ledger(self.args.bidsroot+self.args.subject_file))
+
+    def make_root_files(self):
+
+        # Make the BIDS root level files once, up front, so workers do not race to create them
+        Pathlib(self.args.bidsroot).mkdir(parents=True, exist_ok=True)
+        make_dataset_description(path=self.args.bidsroot, name="[Unspecified]", dataset_type="raw", overwrite=False)
 
     def single_pull(self):
 
-        self.write_lock = None
-        file_indices    = np.array(range(self.input_files.size))
-        self.pull_data(file_indices)
+        self.make_root_files()
+        file_indices = np.array(range(self.input_files.size))
+        if self.args.pipeline_depth > 0:
+            self.write_results = queue.Queue()
+        return self.pull_data(file_indices)
 
     def multicore_pull(self):
 
-        # Make a multiprocess lock
-        self.write_lock = multiprocessing.Lock()
+        self.make_root_files()
+
+        # Workers pull the next file off a shared queue as soon as they are free, longest recordings first. Files that are
+        # already converted never reach the workers.
+        file_indices = np.arange(self.input_files.size)
+        if not self.args.retry_failures:
+            pending      = np.array([not self.is_done(idx) for idx in file_indices],dtype=bool)
+            if (~pending).any():
+                print(f"Skipping {(~pending).sum()} files that are already converted.")
+            file_indices = file_indices[pending]
+        if file_indices.size == 0:
+            return
+        file_indices = self.schedule_files(file_indices)
+        write_lock = multiprocessing.Lock()
+        if self.args.pipeline_depth > 0:
+            self.write_results = multiprocessing.Queue()
+        results = []
+        queued  = {}
+        pool    = multiprocessing.Pool(self.args.ncpu, initializer=init_worker, initargs=(self,write_lock,self.write_results))
+        for result in pool.imap_unordered(pull_worker, file_indices, chunksize=1):
+
+            # Files handed to the writer stage only count as finished once the writer reports them
+            if result['status'] == 'queued':
+                queued[result['idx']] = result
+                finished = []
+            else:
+                finished = [result]
+            for iresult in finished+self.drain_writes(queued):
+                results.append(iresult)
+                print(f"Finished {iresult['file']} ({iresult['status']}). ({len(results):04d}/{file_indices.size:04d})")
+
+        # Let the workers exit cleanly rather than terminating them, so any background writes still queued finish first
+        pool.close()
+        pool.join()
+        for iresult in self.drain_writes(queued,block=True):
+            results.append(iresult)
+            print(f"Finished {iresult['file']} ({iresult['status']}). ({len(results):04d}/{file_indices.size:04d})")
+
+        # Summarize the run. Session counters are cumulative per worker, so keep the latest value from each one.
+        results  = PD.DataFrame(results)
+        counters = results.groupby('pid')[['n_logins','n_opens']].max().sum()
+        print(results['status'].value_counts().to_string())
+        print(f"iEEG.org sessions opened: {counters['n_logins']}. Datasets opened: {counters['n_opens']}.")
+        return results
+
+    def schedule_files(self, file_indices):
+        """
+        Order the file indices so the largest requests are handed out first.
+
+        Annotation requests cover the whole recording, so their size is the length of the dataset as recorded in the
+        metadata cache. Datasets the cache has not seen yet are not looked up here, which would hold every worker back
+        until each one was opened. The workers cache them as they download, so later runs can order them too.
 
-        # Make the BIDS root data structure with a single core to avoid top-level directory issues
-        self.pull_data(np.array([0]))
+        Args:
+            file_indices (array): Indices of the files to schedule
 
-        # Calculate the size of each subset based on the number of processes
-        file_indices = np.array(range(self.input_files.size-1))+1
-        subset_size  = (file_indices.size) // self.args.ncpu
-        list_subsets = [file_indices[i:i + subset_size] for i in range(0, file_indices.size, subset_size)]
+        Returns:
+            array: File indices sorted by decreasing requested duration. Files without a known size keep their input order at the end.
+        """
 
-        # Handle leftovers
-        if len(list_subsets) > self.args.ncpu:
-            arr_ncpu  = list_subsets[self.args.ncpu-1]
-            arr_ncpu1 = list_subsets[self.args.ncpu]
+        sizes = np.array(self.durations,dtype=float)[file_indices]
+        sizes[~np.isfinite(sizes)] = -1
 
-            list_subsets[self.args.ncpu-1] = np.concatenate((arr_ncpu,arr_ncpu1), axis=0)
-            list_subsets.pop(-1)
+        if self.args.annotations:
+            metadata = get_metadata_cache(metadata_path(self.args.bidsroot+self.args.subject_file))
+            for pos,idx in enumerate(file_indices):
+                record = metadata.get(self.input_files[idx])
+                if record != None:
+                    sizes[pos] = record['end_time']-record['start_time']
+        return file_indices[np.argsort(-sizes,kind='stable')]
 
-        processes = []
-        for data_chunk in list_subsets:
-            process = multiprocessing.Process(target=self.pull_data, args=(np.array([data_chunk])))
-            processes.append(process)
-            process.start()
-        
-        # Wait for all processes to complete
-        for process in processes:
-            process.join()
+    def is_done(self,file_idx):
+        times = times_key(self.args,self.start_times[file_idx],self.durations[file_idx])
+        return self.index.is_done(self.input_files[file_idx],times,source_type(self.args))
+
+    def drain_writes(self, queued, block=False):
+        """
+        Collect what the writer stage reported for files handed to it.
+
+        Args:
+            queued (dict): Task summaries of the files still being written, keyed by input row. Finished files are removed.
+            block (bool, optional): Wait for every queued file. Only used once the writers have been closed, so a file the
+                                    writer never reported is counted as failed.
+
+        Returns:
+            list: Task summaries of the files that finished, with the status the writer reported.
+        """
+
+        finished = []
+        while True:
+
+            # A report can come in before the task result that queued its file, so reports are kept until they are matched
+            for idx in [idx for idx in queued.keys() if idx in self.write_reports]:
+                result           = queued.pop(idx)
+                result['status'] = self.write_reports.pop(idx)['status']
+                finished.append(result)
+            if len(queued) == 0:
+                break
+
+            try:
+                if block:
+                    report = self.write_results.get(timeout=60)
+                else:
+                    report = self.write_results.get_nowait()
+            except queue.Empty:
+                break
+            self.write_reports[report['idx']] = report
+
+        if block:
+            for idx in list(queued.keys()):
+                result           = queued.pop(idx)
+                result['status'] = 'failed'
+                finished.append(result)
+        return finished
 
     def pull_data(self,file_indices):
 
-        # Loop over files
-        IEEG = iEEG_download(self.args,self.write_lock)
+        # Loop over files. Close the writer stage before collecting its reports, so every queued write is done.
+        results = {}
         for file_idx in file_indices:
+            results[file_idx] = self.pull_file(file_idx)
+        close_bids_writer()
+        queued = dict((idx,iresult) for idx,iresult in results.items() if iresult['status'] == 'queued')
+        self.drain_writes(queued,block=True)
 
-            # Get the current file
-            ifile = self.input_files[file_idx]
+        # Report how many login round-trips this worker needed
+        pool = get_session_pool(self.args.username,self.args.password,self.args.chunk_concurrency,self.args.request_timeout,self.limiter)
+        print(f"iEEG.org sessions opened: {pool.n_logins}. Datasets opened: {pool.n_opens}.")
+        return PD.DataFrame(list(results.values()))
 
-            # Make sure the data exists or not
-            runflag = True
-            pinds   = (self.processed_files==ifile)
+    def pull_file(self,file_idx):
+        """
+        Download and convert a single entry of the input data.
+
+        Args:
+            file_idx (int): Index of the file in the input data
+
+        Returns:
+            dict: Summary of the task with the input row, file name, status, and the worker session counters. The status is
+                  'queued' while the writer stage still holds clips of the file.
+        """
+
+        # Get the current file
+        ifile  = self.input_files[file_idx]
+        status = 'skipped'
+
+        # Make sure the data exists or not. Failure replays always run since the file can be partially converted.
+        runflag = self.args.retry_failures or not self.is_done(file_idx)
+
+        if runflag:
+            if not self.args.multithread:
+                print("Downloading %s. (%04d/%04d)" %(ifile,file_idx+1,self.input_files.size))
+            else:
+                print(f"Downloading {ifile}.")
+            iid    = self.input_data['uid'].values[file_idx]
+            target = self.input_data['target'].values[file_idx]
+            IEEG   = iEEG_download(self.args,self.write_lock,self.limiter,self.write_results)
+            IEEG.input_idx = file_idx
             try:
-                if pinds.any():
-                    times = self.processed_times[pinds]
-                    if self.args.annotations:
-                        if (times=='annots').any():
-                            runflag = False
-                    else:
-                        itime = f"{self.args.start}_{self.args.duration}"
-                        if (times==itime).any():
-                            runflag = False
-            except (IndexError, AttributeError):
-                pass
-
-            if runflag:
-                if not self.args.multithread:
-                    print("Downloading %s. (%04d/%04d)" %(ifile,file_idx+1,self.input_files.size))
+                if self.args.annotations:
+                    IEEG.download_by_annotation(iid,ifile,target,self.proposed_sub[file_idx],self.windows[file_idx])
                 else:
-                    print(f"Downloading {ifile}.")
-                iid    = self.input_data['uid'].values[file_idx]
-                target = self.input_data['target'].values[file_idx]
-                try:
-                    if self.args.annotations:
-                        IEEG.download_by_annotation(iid,ifile,target,self.proposed_sub[file_idx])
-                        IEEG = iEEG_download(self.args,self.write_lock)
-                    else:
-                        IEEG.download_by_cli(iid,ifile,target,self.start_times[file_idx],self.durations[file_idx],self.proposed_sub[file_idx],file_idx)
-                except UnboundLocalError:
-                    pass
-            else:
-                print("Skipping %s." %(ifile))
+                    IEEG.download_by_cli(iid,ifile,target,self.start_times[file_idx],self.durations[file_idx],self.proposed_sub[file_idx],self.file_indices[file_idx])
+                status = 'downloaded' if IEEG.success_flag else 'failed'
+                if IEEG.pending_write:
+                    status = 'queued'
+            except UnboundLocalError:
+                status = 'failed'
+            except Exception as e:
+                # Keep a single bad file from taking down the rest of the queue, and log it so a replay converts it again
+                print(f"Unable to convert {ifile}: {e}")
+                status = 'failed'
+                if self.args.annotations:
+                    IEEG.log_failure(-1,-1,e)
+                else:
+                    IEEG.log_failure(self.start_times[file_idx],self.durations[file_idx],e)
+        else:
+            print("Skipping %s." %(ifile))
+
+        pool = get_session_pool(self.args.username,self.args.password,self.args.chunk_concurrency,self.args.request_timeout,self.limiter)
+        return {'idx':file_idx,'file':ifile,'status':status,'pid':getpid(),'n_logins':pool.n_logins,'n_opens':pool.n_opens}
@@ -0,0 +1,74 @@
+import json
+from os import path
+
+class metadata_cache:
+    """
+    Per-dataset channel metadata (labels, sample rates, recording times).
+
+    Entries are kept in memory for the life of the worker and appended as JSON lines to a file next to the subject map,
+    so later clips and later runs reuse them instead of looking up every channel again.
+    """
+
+    def __init__(self, fpath):
+        self.fpath   = fpath
+        self.entries = {}
+        self.load()
+
+    def load(self):
+
+        if path.exists(self.fpath):
+            for iline in open(self.fpath,'r'):
+                try:
+                    record = json.loads(iline)
+                    self.entries[record['dataset']] = record
+                except (ValueError, KeyError):
+                    # Skip lines cut short by an interrupted write
+                    pass
+
+    def get(self, name, dataset=None, write_lock=None):
+        """
+        Return the metadata for a dataset, looking it up on the open dataset the first time it is seen.
+
+        Args:
+            name (str): iEEG.org dataset name
+            dataset (ieeg.dataset.Dataset, optional): Open dataset to read the metadata from if it is not cached yet.
+            write_lock (multiprocessing.Lock, optional): Lock to hold while appending to the metadata file.
+
+        Returns:
+            dict: Metadata record, or None if it is not cached and no dataset was given.
+        """
+
+        if name not in self.entries and dataset != None:
+            channels = list(dataset.ch_labels)
+            details  = [dataset.get_time_series_details(ichannel) for ichannel in channels]
+            record   = {'dataset':name,
+                        'channels':channels,
+                        'sample_rates':[idetail.sample_rate for idetail in details],
+                        'n_samples':[idetail.number_of_samples for idetail in details],
+                        'start_time':int(dataset.start_time),
+                        'end_time':int(dataset.end_time)}
+            self.entries[name] = record
+            self.persist(record,write_lock)
+        return self.entries.get(name)
+
+    def persist(self, record, write_lock=None):
+
+        line = json.dumps(record)+'\n'
+        if write_lock != None:
+            with write_lock:
+                with open(self.fpath,'a') as fp:
+                    fp.write(line)
+        else:
+            with open(self.fpath,'a') as fp:
+                fp.write(line)
+
+# One cache per metadata file in each process
+caches = {}
+
+def get_metadata_cache(fpath):
+    if fpath not in caches:
+        caches[fpath] = metadata_cache(fpath)
+    return caches[fpath]
+
+def metadata_path(subject_path):
+    return path.splitext(subject_path)[0]+'_channels.jsonl'
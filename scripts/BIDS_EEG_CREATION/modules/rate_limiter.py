@@ -0,0 +1,59 @@
+import multiprocessing
+from time import sleep, time
+
+# HTTP status codes iEEG.org answers with when it wants clients to slow down
+throttle_codes = [429,503]
+
+class rate_limiter:
+    """
+    Token bucket shared by every worker process that caps the total iEEG.org request rate.
+
+    The allowed rate is halved when the service throttles a request, at most once per cooldown so a burst of throttled
+    requests from every worker only counts once, and recovers in small steps on success. Tokens are taken before a call
+    starts, so time spent waiting on the limiter never counts against the call timeout. The state lives in shared memory,
+    so the limiter has to be created in the parent process and handed to the workers when they start.
+    """
+
+    def __init__(self, max_rate, burst=None, min_rate=None, cooldown=10):
+        self.max_rate = max_rate
+        self.min_rate = min_rate if min_rate != None else 0.1*max_rate
+        self.burst    = burst if burst != None else max(1,max_rate)
+        self.cooldown = cooldown
+        self.lock     = multiprocessing.Lock()
+        self.rate     = multiprocessing.RawValue('d',max_rate)
+        self.tokens   = multiprocessing.RawValue('d',self.burst)
+        self.stamp    = multiprocessing.RawValue('d',time())
+        self.penalty  = multiprocessing.RawValue('d',0)
+
+    def acquire(self, n_tokens=1):
+        """
+        Block until n_tokens requests are allowed.
+        """
+
+        if self.max_rate <= 0:
+            return
+
+        for itoken in range(n_tokens):
+            while True:
+                with self.lock:
+
+                    # Refill the bucket for the time since the last request
+                    now               = time()
+                    self.tokens.value = min(self.burst,self.tokens.value+(now-self.stamp.value)*self.rate.value)
+                    self.stamp.value  = now
+                    if self.tokens.value >= 1:
+                        self.tokens.value -= 1
+                        break
+                    wait_time = (1-self.tokens.value)/self.rate.value
+                sleep(wait_time)
+
+    def penalize(self):
+        with self.lock:
+            now = time()
+            if now-self.penalty.value >= self.cooldown:
+                self.rate.value    = max(self.min_rate,0.5*self.rate.value)
+                self.penalty.value = now
+
+    def reward(self):
+        with self.lock:
+            self.rate.value = min(self.max_rate,self.rate.value+0.05*self.max_rate)
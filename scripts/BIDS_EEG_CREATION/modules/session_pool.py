@@ -0,0 +1,114 @@
+import os
+from time import time
+from collections import OrderedDict
+from ieeg.auth import Session
+from requests.adapters import HTTPAdapter
+from modules.rate_limiter import throttle_codes
+
+class timeout_adapter(HTTPAdapter):
+    """
+    HTTP adapter that applies a default (connect, read) timeout to every request, and slows the shared rate limit down
+    when iEEG.org throttles a request.
+    """
+
+    def __init__(self, timeout, limiter=None, *args, **kwargs):
+        self.timeout = timeout
+        self.limiter = limiter
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+
+        if kwargs.get('timeout') == None:
+            kwargs['timeout'] = self.timeout
+        response = super().send(request, **kwargs)
+
+        # Only an explicit throttle from the service slows every worker down. Timeouts and other errors do not.
+        if self.limiter != None and response.status_code in throttle_codes:
+            self.limiter.penalize()
+        return response
+
+class session_pool:
+    """
+    Per-process pool of authenticated iEEG.org sessions and opened datasets.
+
+    Opening a session and a dataset costs several round-trips to iEEG.org, so we keep both alive across
+    download calls and only reconnect when the session gets too old or an api call on it fails.
+    """
+
+    def __init__(self, username, password, connections=1, timeout=60, limiter=None, max_age=1800, max_datasets=8):
+        self.username     = username
+        self.password     = password
+        self.connections  = connections
+        self.timeout      = timeout
+        self.limiter      = limiter
+        self.max_age      = max_age
+        self.max_datasets = max_datasets
+        self.session      = None
+        self.login_time   = 0
+        self.datasets     = OrderedDict()
+
+        # Round-trip counters
+        self.n_logins = 0
+        self.n_opens  = 0
+
+    def get_session(self):
+
+        # Drop sessions that have been alive for too long
+        if self.session != None and (time()-self.login_time) > self.max_age:
+            self.reset()
+
+        if self.session == None:
+            self.session    = Session(self.username,self.password)
+            self.login_time = time()
+            self.n_logins  += 1
+
+            # Keep one pooled connection per concurrent chunk request, and never wait on a socket forever
+            adapter = timeout_adapter(self.timeout,self.limiter,pool_maxsize=max(self.connections,10))
+            self.session.api.http.mount('https://',adapter)
+            self.session.api.http.mount('http://',adapter)
+        return self.session
+
+    def get_dataset(self, name):
+        """
+        Return an open dataset, reusing the cached one when possible.
+
+        Args:
+            name (str): iEEG.org dataset name
+
+        Returns:
+            ieeg.dataset.Dataset: Open dataset object
+        """
+
+        session = self.get_session()
+        if name in self.datasets:
+            self.datasets.move_to_end(name)
+        else:
+            self.datasets[name] = session.open_dataset(name)
+            self.n_opens       += 1
+
+            # Only keep the most recently used datasets around
+            if len(self.datasets) > self.max_datasets:
+                self.datasets.popitem(last=False)
+        return self.datasets[name]
+
+    def reset(self):
+        """
+        Drop the current session and every dataset opened on it. The next call reconnects.
+        """
+
+        if self.session != None:
+            try:
+                self.session.close()
+            except Exception:
+                pass
+        self.session = None
+        self.datasets.clear()
+
+# One pool per worker process. Keyed by pid so forked workers never reuse the parent's connections.
+pools = {}
+
+def get_session_pool(username, password, connections=1, timeout=60, limiter=None):
+    key = (os.getpid(),username)
+    if key not in pools:
+        pools[key] = session_pool(username,password,connections,timeout,limiter)
+    return pools[key]
@@ -0,0 +1,205 @@
+import os
+import sqlite3
+import threading
+import pandas as PD
+from os import path
+
+class subject_ledger:
+    """
+    Record of every converted file, kept in an SQLite database next to the subject map.
+
+    Workers only ever insert rows, each in its own transaction, so workers in different processes can record files at the
+    same time without losing each other's rows. Lookups by uid and by original filename go through indexes instead of
+    re-reading the whole map. The CSV subject map is imported the first time the ledger is made and written back out in its
+    usual format with export_csv. The CSV can still be edited by hand. Whenever its mtime differs from the one the ledger
+    last read or wrote, it is imported again before the ledger is used or exported.
+    """
+
+    columns = ['orig_filename','source','creator','gendate','uid','subject_number','session_number','times']
+
+    def __init__(self, subject_path, timeout=300):
+        self.subject_path = subject_path
+        self.db_path      = ledger_path(subject_path)
+        self.lock         = threading.Lock()
+
+        # Autocommit mode so transactions are only opened where we ask for them. The background BIDS writer records files
+        # from its own thread, so the connection is shared across threads behind a lock.
+        self.connection = sqlite3.connect(self.db_path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self.create()
+
+    def create(self):
+
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.execute("""CREATE TABLE IF NOT EXISTS subjects (orig_filename TEXT, source TEXT, creator TEXT,
+                                           gendate TEXT, uid TEXT, uid_key TEXT, subject_number INTEGER,
+                                           session_number INTEGER, times TEXT)""")
+                self.connection.execute("CREATE INDEX IF NOT EXISTS subjects_uid ON subjects (uid_key)")
+                self.connection.execute("CREATE INDEX IF NOT EXISTS subjects_file ON subjects (orig_filename)")
+                self.connection.execute("CREATE TABLE IF NOT EXISTS ledger_info (key TEXT PRIMARY KEY, value TEXT)")
+
+                # Bring in the CSV subject map if it is new or was edited. The check runs inside the transaction, so only one
+                # worker imports it.
+                self.sync_csv()
+                self.connection.execute("COMMIT")
+            except:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def get_info(self, key):
+        row = self.connection.execute("SELECT value FROM ledger_info WHERE key=?",(key,)).fetchone()
+        if row == None:
+            return None
+        return row[0]
+
+    def set_info(self, key, value):
+        self.connection.execute("INSERT OR REPLACE INTO ledger_info VALUES (?,?)",(key,str(value)))
+
+    def sync_csv(self):
+        """
+        Import the CSV subject map if it changed since the ledger last read or wrote it. Runs inside an open transaction.
+
+        The CSV replaces the rows it was exported from, so hand edits (including removed rows) are kept. Rows recorded after
+        the last export, e.g. by a run that stopped before exporting, are kept on top of it.
+        """
+
+        if not path.exists(self.subject_path):
+            self.set_info('imported',self.subject_path)
+            return
+        mtime = str(os.stat(self.subject_path).st_mtime_ns)
+        if self.get_info('imported') != None and self.get_info('csv_mtime') == mtime:
+            return
+
+        # Without a recorded export every row is taken to be in the CSV already
+        exported = self.get_info('exported_rowid')
+        if exported == None:
+            exported = self.connection.execute("SELECT COALESCE(MAX(rowid),0) FROM subjects").fetchone()[0]
+        kept = self.connection.execute("SELECT * FROM subjects WHERE rowid>? ORDER BY rowid",(int(exported),)).fetchall()
+
+        subject_DF = PD.read_csv(self.subject_path)
+        self.connection.execute("DELETE FROM subjects")
+        self.connection.executemany("INSERT INTO subjects VALUES (?,?,?,?,?,?,?,?,?)",
+                                    [self.make_row(*irow) for irow in subject_DF[self.columns].values])
+        self.set_info('exported_rowid',self.connection.execute("SELECT COALESCE(MAX(rowid),0) FROM subjects").fetchone()[0])
+        self.connection.executemany("INSERT INTO subjects VALUES (?,?,?,?,?,?,?,?,?)",kept)
+        self.set_info('imported',self.subject_path)
+        self.set_info('csv_mtime',mtime)
+
+    def make_row(self, orig_filename, source, creator, gendate, uid, subject_number, session_number, times):
+        return (str(orig_filename),str(source),str(creator),str(gendate),str(uid),uid_key(uid),int(subject_number),
+                int(session_number),str(times))
+
+    def append(self, orig_filename, source, creator, gendate, uid, subject_number, session_number, times):
+        """
+        Record one converted file.
+        """
+
+        row = self.make_row(orig_filename,source,creator,gendate,uid,subject_number,session_number,times)
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.execute("INSERT INTO subjects VALUES (?,?,?,?,?,?,?,?,?)",row)
+                self.connection.execute("COMMIT")
+            except:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def get_subject_number(self, uid):
+        """
+        Returns:
+            int: Subject number first assigned to this uid, or None if the uid has not been converted yet.
+        """
+
+        with self.lock:
+            row = self.connection.execute("SELECT subject_number FROM subjects WHERE uid_key=? ORDER BY rowid LIMIT 1",
+                                          (uid_key(uid),)).fetchone()
+        if row == None:
+            return None
+        return int(row[0])
+
+    def get_completed(self):
+        """
+        Returns:
+            list: (orig_filename, times, source) of every conversion in the ledger.
+        """
+
+        with self.lock:
+            return self.connection.execute("SELECT orig_filename, times, source FROM subjects").fetchall()
+
+    def to_frame(self):
+
+        with self.lock:
+            return self.read_frame()
+
+    def read_frame(self):
+        rows = self.connection.execute("SELECT %s FROM subjects ORDER BY rowid" %(','.join(self.columns))).fetchall()
+        return PD.DataFrame(rows,columns=self.columns)
+
+    def export_csv(self, fpath=None):
+        """
+        Write the ledger out as a CSV subject map with zero padded subject and session numbers.
+
+        Edits made to the subject map since the ledger last read or wrote it are imported first, so they are never
+        overwritten.
+
+        Args:
+            fpath (str, optional): Output path. Defaults to the subject map the ledger was made for.
+        """
+
+        if fpath == None:
+            fpath = self.subject_path
+        own_csv = (fpath == self.subject_path)
+
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                if own_csv:
+                    self.sync_csv()
+                subject_DF = self.read_frame()
+                subject_DF['subject_number'] = subject_DF['subject_number'].astype(str).str.zfill(4)
+                subject_DF['session_number'] = subject_DF['session_number'].astype(str).str.zfill(4)
+
+                # Write next to the target and swap it in, so a reader never sees half a file
+                tmp_path = f"{fpath}.{os.getpid()}.tmp"
+                subject_DF.to_csv(tmp_path,index=False)
+                os.replace(tmp_path,fpath)
+
+                # Remember what was written, so only later edits trigger an import
+                if own_csv:
+                    self.set_info('csv_mtime',os.stat(fpath).st_mtime_ns)
+                    self.set_info('exported_rowid',self.connection.execute("SELECT COALESCE(MAX(rowid),0) FROM subjects").fetchone()[0])
+                self.connection.execute("COMMIT")
+            except:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+def uid_key(uid):
+    """
+    Normalize a uid for lookups. Inputs are read with numeric downcasting, so the same patient can show up as 12, 12.0 or '12'.
+    """
+
+    try:
+        fuid = float(uid)
+        if fuid.is_integer():
+            return str(int(fuid))
+        return str(fuid)
+    except (ValueError, TypeError):
+        return str(uid)
+
+def ledger_path(subject_path):
+    return path.splitext(subject_path)[0]+'.sqlite'
+
+# SQLite connections cannot cross a fork, so each process opens its own
+ledgers = {}
+
+def get_subject_ledger(subject_path):
+
+    key = (os.getpid(),subject_path)
+    if key not in ledgers:
+        ledgers[key] = subject_ledger(subject_path)
+    return ledgers[key]
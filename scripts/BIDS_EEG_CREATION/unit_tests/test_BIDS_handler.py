@@ -0,0 +1,71 @@
+import glob
+import pytest
+import numpy as np
+from os import path
+
+import EEG_BIDS
+import modules.bids_stage
+from modules.BIDS_handler import BIDS_handler
+
+class clip_writer(BIDS_handler):
+    """
+    Writes one cli clip the way iEEG_download does, without the download.
+    """
+
+    def __init__(self, args, data, fs=256, channels=('Fp1','C3','O1')):
+        self.args         = args
+        self.write_lock   = None
+        self.subject_path = args.bidsroot+args.subject_file
+        self.uid          = 0
+        self.target       = 0
+        self.proposed_sub = 1
+        self.file_idx     = 0
+        self.current_file = 'TEST_FILE'
+        BIDS_handler.__init__(self)
+
+        self.channels = list(channels)
+        self.fs       = fs
+        self.data     = data
+        self.get_channel_type()
+        self.make_info()
+        self.add_raw()
+
+def make_args(bidsroot, extra_args=()):
+    return EEG_BIDS.make_parser().parse_args(['--ieeg','--cli','--bidsroot',bidsroot,'--session','test']+list(extra_args))
+
+def make_data(n_samples=1000):
+    return 50e-6*np.random.default_rng(0).standard_normal((3,n_samples))
+
+@pytest.fixture(autouse=True)
+def fresh_stage(monkeypatch):
+
+    # Staging areas are kept per process, so each test needs its own for its BIDS root
+    monkeypatch.setattr(modules.bids_stage,'stages',{})
+
+def scratch_files(bidsroot):
+    return glob.glob(path.join(bidsroot,'**','.fast_edf_*'),recursive=True)
+
+def test_fast_edf_writes_clip(tmp_path):
+
+    bidsroot = str(tmp_path)+'/'
+    writer   = clip_writer(make_args(bidsroot,['--fast_edf']),make_data())
+    assert isinstance(writer.raws[0],np.ndarray)
+    writer.save_bids()
+
+    assert len(glob.glob(bidsroot+'sub-*/**/*_eeg.edf',recursive=True)) == 1
+    assert scratch_files(bidsroot) == []
+
+@pytest.mark.parametrize('extra_args', [[],['--fast_edf']])
+def test_clip_with_gaps_fails_cleanly(tmp_path, extra_args):
+
+    # A gap in the download is NaN padded. Neither writer can encode it, and neither may leave files behind.
+    bidsroot        = str(tmp_path)+'/'
+    data            = make_data()
+    data[:,100:200] = np.nan
+    writer          = clip_writer(make_args(bidsroot,extra_args),data)
+    assert not isinstance(writer.raws[0],np.ndarray)
+    with pytest.raises(ValueError):
+        writer.save_bids()
+
+    assert glob.glob(bidsroot+'sub-*') == []
+    assert scratch_files(bidsroot) == []
@@ -0,0 +1,96 @@
+import os
+import socket
+import pandas as PD
+
+from modules.bids_stage import bids_stage, staging_path, clean_staging, remove_staging
+
+def stage_file(stage, rel, text=''):
+
+    fpath = os.path.join(stage.root,rel)
+    os.makedirs(os.path.dirname(fpath), exist_ok=True)
+    with open(fpath,'w') as fp:
+        fp.write(text)
+    return fpath
+
+def participants(*subjects):
+    return 'participant_id\tage\n'+''.join([f"{isub}\tn/a\n" for isub in subjects])
+
+def test_commit_moves_files_and_merges_tables(tmp_path):
+
+    bidsroot = str(tmp_path)+'/'
+    with open(bidsroot+'participants.tsv','w') as fp:
+        fp.write(participants('sub-00001'))
+
+    stage = bids_stage(bidsroot)
+    stage.open()
+    stage_file(stage,'sub-00002/ses-test001/eeg/sub-00002_ses-test001_task-task_run-1_eeg.edf','data')
+    stage_file(stage,'participants.tsv',participants('sub-00002'))
+    stage.commit()
+
+    assert os.path.exists(bidsroot+'sub-00002/ses-test001/eeg/sub-00002_ses-test001_task-task_run-1_eeg.edf')
+    live = PD.read_csv(bidsroot+'participants.tsv', sep='\t')
+    assert list(live['participant_id']) == ['sub-00001','sub-00002']
+
+    # The worker directory is gone once the write is committed
+    assert not os.path.exists(stage.path)
+    remove_staging(bidsroot)
+    assert not os.path.exists(staging_path(bidsroot))
+
+def test_scratch_files_are_not_committed(tmp_path):
+
+    bidsroot = str(tmp_path)+'/'
+    stage    = bids_stage(bidsroot)
+    stage.open()
+    scratch  = stage.scratch_file('.fast_edf_','.edf')
+    stage_file(stage,'sub-00001/ses-test001/eeg/sub-00001_ses-test001_task-task_run-1_eeg.edf','data')
+    stage.commit()
+
+    assert sorted(os.listdir(bidsroot)) == ['.staging','sub-00001']
+    assert not os.path.exists(scratch)
+
+def test_discard_drops_partial_output(tmp_path):
+
+    bidsroot = str(tmp_path)+'/'
+    stage    = bids_stage(bidsroot)
+    stage.open()
+    stage_file(stage,'sub-00001/ses-test001/eeg/partial_eeg.edf','data')
+    stage.discard()
+
+    assert not os.path.exists(stage.path)
+    assert not os.path.exists(bidsroot+'sub-00001')
+
+    # The same stage is reused for the next write
+    stage.open()
+    stage_file(stage,'README','readme')
+    stage.commit()
+    assert os.path.exists(bidsroot+'README')
+
+def test_clean_staging_removes_orphans_only(tmp_path):
+
+    bidsroot = str(tmp_path)+'/'
+    root     = staging_path(bidsroot)
+    host     = socket.gethostname()
+    live     = bids_stage(bidsroot)
+    live.open()
+
+    # A pid that cannot be running, the failed writes folder, and a directory of another host touched just now
+    orphan = os.path.join(root,f"{host}_{2**22+1}_deadbeef")
+    remote = os.path.join(root,"otherhost_1_deadbeef")
+    for ipath in [orphan,remote,os.path.join(root,'failed')]:
+        os.makedirs(ipath)
+
+    assert clean_staging(bidsroot) == [orphan]
+    assert sorted(os.listdir(root)) == sorted([os.path.basename(live.path),'failed','otherhost_1_deadbeef'])
+
+def test_remove_staging_keeps_failed_writes(tmp_path):
+
+    bidsroot = str(tmp_path)+'/'
+    stage    = bids_stage(bidsroot)
+    stage.open()
+    failed   = stage.failed_path(os.path.join(stage.root,'sub-00001','clip.pickle'))
+    with open(failed,'w') as fp:
+        fp.write('raw')
+    stage.discard()
+    remove_staging(bidsroot)
+
+    assert os.path.exists(failed)
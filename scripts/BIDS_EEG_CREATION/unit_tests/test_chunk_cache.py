@@ -0,0 +1,47 @@
+import os
+import numpy as np
+
+import modules.chunk_cache
+from modules.chunk_cache import chunk_cache
+
+channels = ['Fp1','C3']
+
+def make_chunk(value, n_samples=1000):
+    return np.full((n_samples,len(channels)),value,dtype=np.float64)
+
+def test_put_and_get(tmp_path):
+
+    cache = chunk_cache(str(tmp_path),max_size_gb=1)
+    assert cache.get('DATASET',0,600,channels) is None
+    cache.put('DATASET',0,600,channels,make_chunk(1.5))
+    assert np.array_equal(cache.get('DATASET',0,600,channels),make_chunk(1.5))
+
+    # A different channel set is a different chunk
+    assert cache.get('DATASET',0,600,['Fp1']) is None
+
+def test_evicts_least_recently_used(tmp_path):
+
+    # Room for four 16 kB chunks
+    cache = chunk_cache(str(tmp_path),max_size_gb=66e-6)
+    for idx in range(4):
+        cache.put('DATASET',idx,1,channels,make_chunk(idx))
+        os.utime(cache.chunk_path('DATASET',idx,1,channels),(idx,idx))
+
+    # Reading the oldest chunk makes it the most recently used, so the next oldest goes first
+    cache.get('DATASET',0,1,channels)
+    cache.put('DATASET',4,1,channels,make_chunk(4))
+    assert cache.get('DATASET',1,1,channels) is None
+    assert [cache.get('DATASET',idx,1,channels) is not None for idx in [0,2,3,4]] == [True]*4
+    assert cache.size <= cache.max_size
+
+def test_scans_only_when_needed(tmp_path, monkeypatch):
+
+    cache = chunk_cache(str(tmp_path),max_size_gb=1)
+    scans = []
+    monkeypatch.setattr(modules.chunk_cache.os,'scandir',lambda root: scans.append(root) or [])
+
+    # 100 chunks of 16 kB stay far below the 1% rescan mark of a 1 GB cache
+    for idx in range(100):
+        cache.put('DATASET',idx,1,channels,make_chunk(idx))
+    assert scans == []
+    assert cache.size == 100*make_chunk(0).nbytes
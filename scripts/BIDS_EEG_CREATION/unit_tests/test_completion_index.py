@@ -0,0 +1,38 @@
+from modules.completion_index import completion_index, window_key, normalize_times
+
+class ledger_rows:
+
+    # Stands in for the subject ledger, which is all the index reads
+    def __init__(self, rows):
+        self.rows = rows
+
+    def get_completed(self):
+        return self.rows
+
+def test_windows_are_told_apart():
+
+    index = completion_index(ledger_rows([('FILE','0_600000000','ieeg.org'),('FILE','annots','ieeg.org')]))
+    assert index.is_done('FILE',window_key(0,600000000),'ieeg.org')
+    assert not index.is_done('FILE',window_key(600000000,600000000),'ieeg.org')
+    assert index.is_done('FILE','annots','ieeg.org')
+
+    # The same file from another source still needs converting
+    assert not index.is_done('FILE','annots','edf')
+
+def test_times_are_normalized():
+
+    # Windows read back from a CSV come in as floats
+    index = completion_index(ledger_rows([('FILE','0.0_6e8','ieeg.org')]))
+    assert index.is_done('FILE',window_key(0,600000000),'ieeg.org')
+    assert index.is_done('FILE',window_key(0.0,600000000.0),'ieeg.org')
+    assert normalize_times('annots') == 'annots'
+    assert normalize_times('nan_nan') == 'nan_nan'
+
+def test_old_maps_cover_every_window():
+
+    # Older subject maps stored None_None for every row, so any window of the file counts as done, but not annotations
+    index = completion_index(ledger_rows([('FILE','None_None','ieeg.org')]))
+    assert index.is_done('FILE',window_key(0,600000000),'ieeg.org')
+    assert index.is_done('FILE',window_key(600000000,1),'ieeg.org')
+    assert not index.is_done('FILE','annots','ieeg.org')
+    assert not index.is_done('OTHER_FILE',window_key(0,600000000),'ieeg.org')
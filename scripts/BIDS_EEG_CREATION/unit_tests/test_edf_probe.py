@@ -0,0 +1,51 @@
+import numpy as np
+from mne.io import read_raw_edf
+from edfio import Edf, EdfSignal
+
+from modules.edf_probe import edf_probe
+
+def make_edf(fpath, n_records=5, fs=256):
+    """
+    EDF with two EEG channels and a Status channel whose calibration and offset are not the identity, so the stim handling
+    shows up in the values.
+    """
+
+    rng     = np.random.default_rng(42)
+    n       = n_records*fs
+    signals = [EdfSignal.from_digital(rng.integers(-32768,32767,n,dtype=np.int16),fs,label=ilabel,physical_dimension='uV',
+                                      physical_range=(-3200,3200),digital_range=(-32768,32767)) for ilabel in ['Fp1','C3']]
+    events  = np.repeat(rng.integers(-2000,2000,n_records*8),fs//8).astype(np.int16)
+    signals.append(EdfSignal.from_digital(events,fs,label='Status',physical_range=(-1000.5,1501.25),digital_range=(-2000,2000)))
+    Edf(signals).write(fpath)
+
+def test_matches_read_raw_edf(tmp_path):
+
+    fpath = str(tmp_path/'status.edf')
+    make_edf(fpath)
+    raw   = read_raw_edf(fpath,verbose=False)
+    probe = edf_probe(fpath)
+    try:
+        assert probe.channels == raw.ch_names
+        assert probe.fs == raw.info['sfreq']
+        data = probe.read()
+        assert np.array_equal(data,raw.get_data())
+
+        # Partial reads and the per channel extremes come from the same scaling
+        assert np.array_equal(probe.read_samples(100,900),raw.get_data(start=100,stop=900))
+        mins,maxs = probe.extremes()
+        assert np.array_equal(mins,data.min(axis=1))
+        assert np.array_equal(maxs,data.max(axis=1))
+    finally:
+        probe.close()
+
+def test_stim_channel_is_event_codes(tmp_path):
+
+    fpath = str(tmp_path/'status.edf')
+    make_edf(fpath)
+    probe = edf_probe(fpath)
+    try:
+        status = probe.read()[probe.channels.index('Status')]
+        assert (status >= 0).all()
+        assert np.array_equal(status,np.round(status))
+    finally:
+        probe.close()
@@ -0,0 +1,60 @@
+import mne
+import pytest
+import warnings
+import numpy as np
+
+from modules.edf_writer import write_edf, stream_edf
+
+# Partial last record, a flat channel, and mixed channel types each change the header
+clips = [(1000,256,['Fp1','C3','EKG1'],['eeg','eeg','ecg']),
+         (2560,256,['LA1','LA2'],['seeg','seeg']),
+         (777,100,['X','G1','G2','S'],['misc','ecog','ecog','misc'])]
+
+def make_data(n_samples, channels):
+
+    data    = 50e-6*np.random.default_rng(n_samples).standard_normal((len(channels),n_samples))
+    data[1] = 3e-6
+    return data
+
+def exported(tmp_path, data, fs, channels, channel_types):
+
+    # What mne_bids writes for the same clip, through mne.export
+    raw   = mne.io.RawArray(data, mne.create_info(channels,float(fs),channel_types), verbose=False)
+    fpath = str(tmp_path/'export.edf')
+    with warnings.catch_warnings():
+        # mne warns when it pads out a partial last record
+        warnings.simplefilter('ignore')
+        mne.export.export_raw(fpath, raw, fmt='edf', verbose=False)
+    return open(fpath,'rb').read()
+
+@pytest.mark.parametrize('n_samples,fs,channels,channel_types', clips)
+def test_write_edf_matches_export(tmp_path, n_samples, fs, channels, channel_types):
+
+    data  = make_data(n_samples,channels)
+    fpath = str(tmp_path/'direct.edf')
+    write_edf(fpath, data, fs, channels, channel_types, block_samples=300)
+    assert open(fpath,'rb').read() == exported(tmp_path,data,fs,channels,channel_types)
+
+@pytest.mark.parametrize('n_samples,fs,channels,channel_types', clips)
+def test_stream_edf_matches_write_edf(tmp_path, n_samples, fs, channels, channel_types):
+
+    data = make_data(n_samples,channels)
+    write_edf(str(tmp_path/'direct.edf'), data, fs, channels, channel_types)
+
+    # Blocks that do not line up with the records, read through a callback like a probed source file
+    reads = []
+    def read_samples(i0, i1):
+        reads.append(i1-i0)
+        return data[:,i0:i1].copy()
+    stream_edf(str(tmp_path/'stream.edf'), read_samples, n_samples, fs, channels, channel_types,
+               data.min(axis=1), data.max(axis=1), 2*fs+1)
+
+    assert max(reads) == 2*fs
+    assert open(tmp_path/'stream.edf','rb').read() == open(tmp_path/'direct.edf','rb').read()
+
+def test_non_finite_data_is_rejected(tmp_path):
+
+    data       = make_data(512,['Fp1','C3'])
+    data[0,10] = np.nan
+    with pytest.raises(ValueError):
+        write_edf(str(tmp_path/'gap.edf'), data, 256, ['Fp1','C3'], ['eeg','eeg'])
@@ -0,0 +1,91 @@
+import numpy as np
+import pandas as PD
+
+import EEG_BIDS
+import modules.session_pool
+from modules.iEEG_handler import ieeg_handler, iEEG_download
+from modules.metadata_cache import get_metadata_cache, metadata_path
+from benchmarks.mock_ieeg import mock_annotation
+
+def make_handler(bidsroot, mode, starts, durations):
+
+    args  = EEG_BIDS.make_parser().parse_args(['--ieeg',mode,'--bidsroot',bidsroot,'--session','test'])
+    files = [f"FILE{idx}" for idx in range(len(starts))]
+    data  = PD.DataFrame({'uid':np.arange(len(files)),'orig_filename':files,'start':starts,'duration':durations,
+                          'target':0,'proposed_subnum':np.arange(len(files))+1})
+    return ieeg_handler(args,data)
+
+def cache_length(bidsroot, name, length):
+
+    # Record just what the scheduler reads from the cache
+    cache = get_metadata_cache(metadata_path(bidsroot+'subject_map.csv'))
+    cache.entries[name] = {'dataset':name,'start_time':0,'end_time':length}
+
+def test_cli_requests_go_longest_first(tmp_path):
+
+    handler = make_handler(str(tmp_path)+'/','--cli',[0,0,0,0],[10,30,20,30])
+    assert list(handler.schedule_files(np.arange(4))) == [1,3,2,0]
+    assert list(handler.schedule_files(np.array([0,2]))) == [2,0]
+
+def test_annotation_sizes_come_from_the_cache_only(tmp_path, monkeypatch):
+
+    # Nothing may be opened on iEEG.org before the workers start
+    def no_session(*args, **kwargs):
+        raise AssertionError("schedule_files opened an iEEG.org session")
+    monkeypatch.setattr(modules.session_pool,'Session',no_session)
+
+    bidsroot = str(tmp_path)+'/'
+    handler  = make_handler(bidsroot,'--annotations',[-1]*5,[-1]*5)
+    cache_length(bidsroot,'FILE1',100)
+    cache_length(bidsroot,'FILE3',500)
+
+    # Cached datasets go first by length, the others keep their manifest order
+    assert list(handler.schedule_files(np.arange(5))) == [3,1,0,2,4]
+
+def clip_layer(*bounds):
+    annotations = []
+    for istart,iend in bounds:
+        annotations.append(mock_annotation('Clip Start','Clip Start',istart,istart))
+        annotations.append(mock_annotation('Clip End','Clip End',iend,iend))
+    return annotations
+
+def match_annotations(clips, times, end_time=1000):
+    """
+    Run get_annotations on a clip layer and Natus events at the given times, without calling iEEG.org.
+    """
+
+    IEEG = iEEG_download.__new__(iEEG_download)
+    def session_method_handler(start, duration, annotation_flag=False):
+        IEEG.clips           = clips
+        IEEG.raw_annotations = [mock_annotation('Annotation',f"event {itime}",itime,itime) for itime in times]
+        IEEG.start_time      = 0
+        IEEG.end_time        = end_time
+        IEEG.success_flag    = True
+    IEEG.session_method_handler = session_method_handler
+    IEEG.get_annotations()
+    return IEEG
+
+def test_annotations_land_in_their_clip():
+
+    IEEG = match_annotations(clip_layer((0,100),(200,300)),[50,300,150,250,0])
+    assert list(IEEG.clip_start_times) == [0,200]
+    assert list(IEEG.clip_durations) == [100,100]
+
+    # Offsets are relative to the clip start, and events between clips are dropped
+    assert IEEG.annotations == {0:{50:'event 50',0:'event 0'},1:{100:'event 300',50:'event 250'}}
+    assert sorted(IEEG.annotation_flats) == ['event 0','event 250','event 300','event 50']
+
+def test_shared_boundary_goes_to_the_later_clip():
+
+    # An event on the end of one clip and the start of the next is only written once, with the clip it starts
+    IEEG = match_annotations(clip_layer((0,100),(100,200)),[100])
+    assert IEEG.annotations == {0:{},1:{0:'event 100'}}
+
+def test_open_ended_clips():
+
+    # A layer that starts on a clip end and stops on a clip start covers the recording from its start and to its end
+    clips = clip_layer((0,100),(200,300))[1:-1]
+    IEEG  = match_annotations(clips,[50,150,250,900],end_time=1000)
+    assert list(IEEG.clip_start_times) == [0,200]
+    assert list(IEEG.clip_end_times) == [100,1000]
+    assert IEEG.annotations == {0:{50:'event 50'},1:{50:'event 250',700:'event 900'}}
@@ -0,0 +1,60 @@
+import glob
+import multiprocessing
+from os import path
+
+import EEG_BIDS
+from benchmarks.mock_ieeg import mock_service, install
+
+# Six minute recordings with one minute clips starting every 90 seconds
+service = mock_service(n_channels=4, fs=64, min_hours=0.1, max_hours=0.1, clip_minutes=1, gap_minutes=0.5, latency=0)
+
+def run_main(cli_args, queue):
+
+    # The per process caches are keyed by pid, so every run gets a fresh process
+    install(service)
+    queue.put(EEG_BIDS.main(EEG_BIDS.make_parser().parse_args(cli_args)))
+
+def replay(bidsroot, extra_args=()):
+
+    cli_args = ['--ieeg','--username','mock','--password','mock','--bidsroot',bidsroot,'--session','test',
+                '--annotations','--retry_failures','--request_timeout','5']+list(extra_args)
+    context  = multiprocessing.get_context('fork')
+    queue    = context.Queue()
+    process  = context.Process(target=run_main, args=(cli_args,queue))
+    process.start()
+    n_failed = queue.get(timeout=300)
+    process.join()
+    return n_failed
+
+def clip_files(bidsroot, subnum):
+    return glob.glob(path.join(bidsroot,f"sub-{subnum:05d}",'**','*.edf'),recursive=True)
+
+def test_replay_whole_file_and_clip_failures(tmp_path):
+
+    # One file whose annotation call failed and one file with a single failed clip
+    bidsroot = str(tmp_path)+'/'
+    starts   = [istart for istart,iend in service.clip_windows('MOCKB')]
+    with open(bidsroot+'failed_ieeg_calls.csv','w') as fp:
+        fp.write("0,MOCKA,-1,-1,0,-1,'Injected failure'\n")
+        fp.write(f"1,MOCKB,{starts[1]},60000000,1,-1,'Injected failure'\n")
+
+    assert replay(bidsroot) == 0
+    assert not path.exists(bidsroot+'failed_ieeg_calls.csv')
+    assert path.exists(bidsroot+'failed_ieeg_calls.csv.replayed')
+
+    # The whole file is converted again, but only the failed clip of the other one
+    assert len(clip_files(bidsroot,1)) == len(service.clip_windows('MOCKA'))
+    assert len(clip_files(bidsroot,2)) == 1
+
+def test_replay_only_whole_file_failures(tmp_path):
+
+    # Every row restarts a whole file, so there are no clip windows at all
+    bidsroot = str(tmp_path)+'/'
+    with open(bidsroot+'failed_ieeg_calls.csv','w') as fp:
+        fp.write("0,MOCKA,-1,-1,0,-1,'Injected failure'\n")
+        fp.write("1,MOCKB,-1,-1,1,-1,'Injected failure'\n")
+
+    assert replay(bidsroot,['--multithread','--ncpu','2']) == 0
+    assert not path.exists(bidsroot+'failed_ieeg_calls.csv')
+    assert len(clip_files(bidsroot,1)) == len(service.clip_windows('MOCKA'))
+    assert len(clip_files(bidsroot,2)) == len(service.clip_windows('MOCKB'))
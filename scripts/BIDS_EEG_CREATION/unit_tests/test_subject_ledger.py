@@ -0,0 +1,68 @@
+import os
+import pandas as PD
+
+from modules.subject_ledger import subject_ledger, uid_key
+
+columns = ['orig_filename','source','creator','gendate','uid','subject_number','session_number','times']
+
+def write_map(fpath, rows):
+    PD.DataFrame(rows,columns=columns).to_csv(fpath,index=False)
+
+def bump_mtime(fpath):
+
+    # Make sure a hand edit is seen even on filesystems with coarse timestamps
+    stat = os.stat(fpath)
+    os.utime(fpath,ns=(stat.st_atime_ns,stat.st_mtime_ns+10**9))
+
+def test_imports_existing_map(tmp_path):
+
+    fpath = str(tmp_path/'subject_map.csv')
+    write_map(fpath,[['FILE1','ieeg.org','user','01-01-24',12,1,1,'annots'],
+                     ['FILE2','ieeg.org','user','01-01-24','13',2,1,'0_600000000']])
+    ledger = subject_ledger(fpath)
+    assert ledger.get_subject_number(12) == 1
+    assert ledger.get_subject_number('12.0') == 1
+    assert ledger.get_subject_number(13) == 2
+    assert ledger.get_subject_number(14) == None
+    assert sorted(ledger.get_completed()) == [('FILE1','annots','ieeg.org'),('FILE2','0_600000000','ieeg.org')]
+
+def test_export_round_trip(tmp_path):
+
+    fpath  = str(tmp_path/'subject_map.csv')
+    ledger = subject_ledger(fpath)
+    ledger.append('FILE1','ieeg.org','user','01-01-24',12,1,1,'annots')
+    ledger.append('FILE2','edf','user','01-01-24',12,1,2,'None_None')
+    ledger.export_csv()
+
+    # Numbers are zero padded like the original subject map
+    exported = PD.read_csv(fpath,dtype=str)
+    assert list(exported.columns) == columns
+    assert list(exported['subject_number']) == ['0001','0001']
+    assert list(exported['session_number']) == ['0001','0002']
+
+    # A fresh ledger reads the same rows back, without importing the CSV on top of them
+    ledger.close()
+    reopened = subject_ledger(fpath)
+    assert reopened.to_frame().shape[0] == 2
+
+def test_hand_edits_survive_export(tmp_path):
+
+    fpath  = str(tmp_path/'subject_map.csv')
+    ledger = subject_ledger(fpath)
+    ledger.append('FILE1','ieeg.org','user','01-01-24',12,1,1,'annots')
+    ledger.append('FILE2','ieeg.org','user','01-01-24',13,2,1,'annots')
+    ledger.export_csv()
+
+    # Drop one row by hand, then record another file before the next export
+    edited = PD.read_csv(fpath)
+    edited.loc[edited['orig_filename']!='FILE1'].to_csv(fpath,index=False)
+    bump_mtime(fpath)
+    ledger.append('FILE3','ieeg.org','user','01-01-24',14,3,1,'annots')
+    ledger.export_csv()
+
+    assert list(PD.read_csv(fpath)['orig_filename']) == ['FILE2','FILE3']
+    assert ledger.get_subject_number(12) == None
+
+def test_uid_key():
+    assert uid_key(12) == uid_key(12.0) == uid_key('12') == '12'
+    assert uid_key('HUP123') == 'HUP123'
@@ -1,8 +1,11 @@
 import os
 import mne
 import json
+import fcntl
+import errno
 import shutil
 import pickle
+import hashlib
 import pydicom
 import argparse
 import mne_bids
@@ -10,12 +13,283 @@ import numpy as np
 import pandas as PD
 from os import path
 from sys import exit
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import nibabel as nib
 from pathlib import Path as Pathlib
 
 from bids import BIDSLayout
+from bids_validator import BIDSValidator
 from bids.layout.writing import build_path
 
+class layout_index:
+    """
+    Entities of every file in the BIDS root, for the layout summary kept in dataset_description.json.
+
+    The existing tree is indexed with a single BIDSLayout when the run starts. Files placed afterwards are parsed on their own
+    and added to the index, so the tree is never walked again. The summary is written every `interval` new files, and at
+    the end of the run with write_summary.
+    """
+
+    def __init__(self, bidsroot, interval=0):
+        self.bidsroot  = bidsroot
+        self.interval  = interval
+        self.pending   = 0
+        self.layout    = BIDSLayout(bidsroot)
+        self.validator = BIDSValidator()
+        self.records   = {}
+        for irecord in self.layout.to_df().to_dict('records'):
+            self.records[irecord.pop('path')] = irecord
+
+    def add(self, fpath):
+
+        # Only files the layout itself would index go in the table
+        fpath = path.abspath(fpath)
+        if self.validator.is_bids('/'+path.relpath(fpath,self.layout.root)):
+            self.records[fpath] = self.layout.parse_file_entities(fpath)
+        self.pending += 1
+        if self.interval > 0 and self.pending >= self.interval:
+            self.write_summary()
+
+    def to_df(self):
+        """
+        Returns:
+            DataFrame: Same table as BIDSLayout.to_df, one row per file and one column per entity.
+        """
+
+        # Long table of tags pivoted to wide, the way pybids builds it, so the values keep their types
+        tags = [[ipath,ientity,ivalue] for ipath,irecord in self.records.items() for ientity,ivalue in irecord.items()
+                if not (isinstance(ivalue,float) and np.isnan(ivalue))]
+        DF   = PD.DataFrame(tags, columns=['path','entity','value'])
+        DF   = DF.pivot(index='path', columns='entity', values='value')
+
+        # Files without any entities still get a row
+        for ipath in set(self.records.keys())-set(DF.index):
+            DF.loc[ipath] = PD.Series(dtype=float)
+        return DF.reset_index()
+
+    def write_summary(self):
+
+        # Nothing new since the last write
+        if self.pending == 0:
+            return
+
+        # Save the bids layout
+        output_path = os.path.join(self.bidsroot, 'dataset_description.json')
+        with open(output_path, 'r') as f:
+            existing_data = json.load(f)
+        json_output = self.to_df().to_dict()
+        merged_data = {**existing_data, **json_output}
+
+        # Save the updated data back to the JSON file
+        with open(output_path, 'w') as f:
+            json.dump(merged_data, f, indent=4)
+        self.pending = 0
+
+# Extensions of the files that make up one series. Longer ones first, so .nii.gz is not taken for .gz.
+series_exts = ['nii.gz','nii','json','bval','bvec']
+
+class file_index:
+    """
+    Every series under the search path, found with a single walk of the tree.
+
+    Files are grouped by directory and exact stem, so each JSON sidecar maps straight to its NIfTI, bval and bvec siblings.
+    With a cache file, directory listings are kept between runs and only directories whose mtime changed are listed again.
+    """
+
+    def __init__(self, searchpath, cache_path=None):
+        self.cache_path = cache_path
+        self.listings   = {}
+        self.series     = {}
+        self.jsons      = []
+
+        # Listings from the last run, keyed by directory with the mtime they were made at
+        cached = {}
+        if cache_path != None and path.exists(cache_path):
+            with open(cache_path,"rb") as fp:
+                cached = pickle.load(fp)
+
+        self.scan(searchpath,cached)
+        if cache_path != None:
+            with open(cache_path,"wb") as fp:
+                pickle.dump(self.listings,fp)
+
+    def scan(self, dirpath, cached):
+
+        # Adding, removing or renaming an entry changes the mtime of its directory, so an unchanged mtime means the
+        # listing still holds
+        mtime = os.stat(dirpath).st_mtime_ns
+        if dirpath in cached and cached[dirpath][0] == mtime:
+            files,subdirs = cached[dirpath][1:]
+        else:
+            files,subdirs = [],[]
+            # Symlinked directories are not followed, same as rglob, so a link loop or a link to another part of the tree
+            # is not walked again
+            for ientry in os.scandir(dirpath):
+                if ientry.is_dir(follow_symlinks=False):
+                    subdirs.append(ientry.name)
+                else:
+                    files.append(ientry.name)
+        self.listings[dirpath] = (mtime,files,subdirs)
+
+        for ifile in files:
+            stem,ext = split_series(ifile)
+            if stem != None:
+                self.series.setdefault((dirpath,stem),{})[ext] = os.path.join(dirpath,ifile)
+                if ext == 'json':
+                    self.jsons.append(os.path.join(dirpath,ifile))
+
+        # Sidecars are kept in the same top down order as rglob, which set the order runs are numbered in
+        for isub in subdirs:
+            self.scan(os.path.join(dirpath,isub),cached)
+
+    def sidecars(self):
+        return list(self.jsons)
+
+    def siblings(self, sidecar):
+        """
+        Returns:
+            dict: Path of every file in the series of this JSON sidecar, keyed by extension.
+        """
+
+        dirpath,fname = os.path.split(str(sidecar))
+        return self.series[(dirpath,split_series(fname)[0])]
+
+def split_series(fname):
+    """
+    Split a file name into its series stem and extension, e.g. 'T1.nii.gz' into 'T1' and 'nii.gz'.
+    """
+
+    for iext in series_exts:
+        if fname.endswith('.'+iext):
+            return fname[:-len(iext)-1],iext
+    return None,None
+
+class run_context:
+    """
+    Lookups every series of a run needs, loaded once: the datalake and the map of (subject, acquisition date) to session.
+
+    Sessions entered during the run are added to the map right away and written to the date file together by flush, which
+    the wrapper calls at the end of the run or when it is interrupted. Files to place are collected in placements.
+    """
+
+    def __init__(self, datalake_path, datefile):
+        self.datalake   = pickle.load(open(datalake_path,"rb"))
+        self.datefile   = datefile
+        self.pending    = []
+        self.placements = []
+
+        # Check to see if the date file exists, if not, create it
+        if path.exists(datefile):
+            self.dates = PD.read_csv(datefile, dtype={'DATES':str})
+        else:
+            self.dates = PD.DataFrame(columns=['SUBJECT','DATES','SESSION_TYPE'])
+
+        # A date listed more than once for a subject is ambiguous, and is asked for again like an unknown one
+        keys          = list(zip(self.dates.SUBJECT.astype(int),self.dates.DATES.astype(str)))
+        counts        = Counter(keys)
+        self.sessions = {}
+        for ikey,isession in zip(keys,self.dates.SESSION_TYPE.values):
+            if counts[ikey] == 1:
+                self.sessions[ikey] = isession
+
+    def get_session(self, subject, acq_date):
+        return self.sessions.get((int(subject),str(acq_date)))
+
+    def add_session(self, subject, acq_date, session):
+        self.sessions[(int(subject),str(acq_date))] = session
+        self.pending.append([subject,acq_date,session])
+
+    def flush(self):
+
+        # Nothing new since the last write
+        if len(self.pending) == 0:
+            return
+
+        # Update the dataframe for future entries that match
+        self.dates   = PD.concat((self.dates,PD.DataFrame(self.pending,columns=self.dates.columns)))
+        self.dates.to_csv(self.datefile,index=False)
+        self.pending = []
+
+# Linux ioctl that clones a file's extents into another file on filesystems that support it (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+def place_file(src, dst, mode='copy', verify=False):
+    """
+    Place one source file at its BIDS path.
+
+    Args:
+        src (str): Source file
+        dst (str): BIDS path
+        mode (str, optional): 'copy', 'hardlink', 'reflink' or 'symlink'. Hardlinks and reflinks fall back to a copy when
+            the filesystem cannot make them.
+        verify (bool, optional): Compare the checksums of source and copy afterwards. Links share their data with the
+            source, so only copies are checked.
+    """
+
+    # Links cannot replace an existing file
+    if path.lexists(dst):
+        os.remove(dst)
+
+    if mode == 'symlink':
+        os.symlink(path.abspath(src),dst)
+        return
+
+    if mode == 'hardlink':
+        try:
+            os.link(src,dst)
+            return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV,errno.EPERM,errno.EMLINK,errno.EOPNOTSUPP):
+                raise
+        shutil.copyfile(src,dst)
+    elif mode == 'reflink':
+        try:
+            with open(src,'rb') as fsrc, open(dst,'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(),FICLONE,fsrc.fileno())
+        except OSError as e:
+            if e.errno not in (errno.EXDEV,errno.EOPNOTSUPP,errno.ENOTTY,errno.EINVAL):
+                raise
+            shutil.copyfile(src,dst)
+    else:
+        shutil.copyfile(src,dst)
+
+    if verify and checksum(src) != checksum(dst):
+        raise IOError("Checksum of %s does not match its source %s." %(dst,src))
+
+def checksum(fpath, block_size=2**24):
+
+    digest = hashlib.sha256()
+    with open(fpath,'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def place_files(placements, index, mode='copy', threads=4, verify=False):
+    """
+    Place every planned file on a thread pool and add each one to the layout index once it is in place.
+
+    Args:
+        placements (list): (source, BIDS path) pairs in the order they were planned. A BIDS path planned twice takes the
+            later source, as the serial copy did.
+        index (layout_index): Layout index of the BIDS root.
+    """
+
+    plan = {}
+    for src,dst in placements:
+        plan.pop(dst,None)
+        plan[dst] = src
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = {executor.submit(place_file,src,dst,mode,verify):dst for dst,src in plan.items()}
+        try:
+            for future in as_completed(futures):
+                future.result()
+                index.add(futures[future])
+        except:
+            executor.shutdown(cancel_futures=True)
+            raise
+
 def make_dataset_description(dataset_description_path):
 
     dataset_description = {
@@ -50,49 +324,57 @@ def wrapper(args):
     searchpath = '/'.join(searcharr[:-1])+'/'
     fname      = searcharr[-1]+"*"
     
+    # Walk the search path once for every series and its files
+    files = file_index(os.path.normpath(searchpath),args.file_index)
+
+    # Index the BIDS root once. Copied files are added to the index as they are placed.
+    index = layout_index(args.bidsroot,args.summary_interval)
+
+    # Read in the datalake and known sessions once for the whole run
+    context = run_context(args.datalake,args.datefile)
+
     # Loop over all the files
     run_dict = {}
-    for path in Pathlib(searchpath).rglob("*json"):
-        args.dataset = path
-        run_dict     = main(args,run_dict,searchpath)
+    try:
+        for path in files.sidecars():
+            args.dataset = path
+            run_dict     = main(args,run_dict,files,context)
 
-def main(args,run_dict,searchpath):
+        # Paths are all planned, place the files in parallel
+        place_files(context.placements,index,args.transfer_mode,args.transfer_threads,args.verify)
+    finally:
+        # Write out new sessions and the layout summary, even if the run is interrupted
+        context.flush()
+        index.write_summary()
+
+def main(args,run_dict,files,context):
 
     # Make sure all command line options filled
     argsdict = vars(args)
-    for ikey in argsdict.keys():
-        if not argsdict[ikey]:
+    for ikey in ['dataset','bidsroot','datalake','datefile','subject']:
+        if argsdict[ikey] == None:
             print("Please specify --%s. Quitting." %(ikey))
             exit()
     
     # Get the associated files and paths
-    localroot   = str(args.dataset).split('/')[-1].strip(".json")+"*"
-    ifile_paths = [str(ifile) for ifile in Pathlib(searchpath).rglob(localroot)]
-    ifile_exts  = ['.'.join(ifile.split('/')[-1].split('.')[1:]) for ifile in ifile_paths]
+    siblings    = files.siblings(args.dataset)
+    ifile_paths = list(siblings.values())
+    ifile_exts  = list(siblings.keys())
     
     # Read in the dicom data
     with open(args.dataset, 'r') as f:
         metadata = json.load(f)
     
-    # Read in the datalake
-    datalake = pickle.load(open(args.datalake,"rb"))
-    
     # Get the acquisition date
     acq_date = metadata["AcquisitionTime"]
     
     # Get the series value
     series = metadata["ProtocolName"].lower()
     
-    # Check to see if the date file exists, if not, create it
-    if path.exists(args.datefile):
-        DF = PD.read_csv(args.datefile)
-    else:
-        DF = PD.DataFrame(columns=['SUBJECT','DATES','SESSION_TYPE'])
-
     # Save the data tpying info
     try:
         if not args.by_path:
-            keyinfo   = datalake['HUP'][series]
+            keyinfo   = context.datalake['HUP'][series]
             scan_type = keyinfo['scan_type']
             data_type = keyinfo['data_type']
             modality  = keyinfo['modality']
@@ -100,7 +382,7 @@ def main(args,run_dict,searchpath):
             acq       = keyinfo['acq']
             ce        = keyinfo['ce']
         else:
-            keyinfo = datalake['']
+            keyinfo = context.datalake['']
     except KeyError:
         write_ignore(args.bidsroot,args.dataset)
         return run_dict
@@ -143,10 +425,8 @@ def main(args,run_dict,searchpath):
     if ce[:3]=='ce-':ce=task[3:]
     
     # Check to see if the date is in the known list
-    dataslice = DF.loc[(DF.SUBJECT.values==int(args.subject))&(DF.DATES.values==acq_date)]
-    if (dataslice.shape[0]==1):
-        session = dataslice['SESSION_TYPE'].values[0]
-    else:
+    session = context.get_session(args.subject,acq_date)
+    if session == None:
         print("\n")
         print("Series Description: %s" %(series))
         print("Scan Type: %s" %(scan_type))
@@ -182,10 +462,8 @@ def main(args,run_dict,searchpath):
         elif user_input == 5:
             session = input("Please enter session name: ")
 
-        # Update the dataframe for future entries that match            
-        iarr = np.array([args.subject,acq_date,session]).reshape((1,3))
-        DF   = PD.concat((DF,PD.DataFrame(iarr,columns=DF.columns)))
-        DF.to_csv(args.datefile,index=False)
+        # Remember the session for the rest of the run. It is written to the date file at the end.
+        context.add_session(args.subject,acq_date,session)
 
     # Maintain the run counter
     try:
@@ -239,22 +517,8 @@ def main(args,run_dict,searchpath):
         Pathlib(rootpath).mkdir(parents=True, exist_ok=True)
         print("Making %s" %(bids_path))
 
-        # Save the nifti to its new home
-        shutil.copyfile(ifile, bids_path)
-
-        # Create a new BIDSLayout object
-        layout = BIDSLayout(args.bidsroot)
-        
-        # Save the bids layout
-        output_path = os.path.join(args.bidsroot, 'dataset_description.json')
-        with open(output_path, 'r') as f:
-            existing_data = json.load(f)
-        json_output = layout.to_df().to_dict()
-        merged_data = {**existing_data, **json_output}
-    
-        # Save the updated data back to the JSON file
-        with open(output_path, 'w') as f:
-            json.dump(merged_data, f, indent=4)
+        # Queue the nifti for its new home. Files are placed once every series is planned.
+        context.placements.append((ifile,bids_path))
     
     return run_dict
     
@@ -269,6 +533,11 @@ if __name__ == '__main__':
     parser.add_argument('--subject', required=True, help='Subject ID.')
     parser.add_argument('--subject', type=str, default='HUP', help='Subject ID.')
     parser.add_argument('--by_path', action='store_true', default=False, help="Use path to determine keywords.")
+    parser.add_argument('--file_index', default=None, help='Optional file to keep the directory listings of the dataset folder in between runs. Only folders that changed since the last run are listed again.')
+    parser.add_argument('--transfer_mode', '--transfer-mode', default='copy', choices=['copy','hardlink','reflink','symlink'], help='How files are placed in the BIDS root. hardlink and reflink fall back to a copy when the filesystem cannot make them.')
+    parser.add_argument('--transfer_threads', type=int, default=4, help='Number of files placed in parallel.')
+    parser.add_argument('--verify', action='store_true', default=False, help='Compare checksums of every copied file against its source.')
+    parser.add_argument('--summary_interval', type=int, default=0, help="Write the layout summary to dataset_description.json every this many copied files. 0 writes it once at the end of the run.")
     args = parser.parse_args()
     
     # Make sure the folders have the right trailing characters